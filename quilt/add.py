@@ -9,9 +9,9 @@
 import os.path
 import stat
 
-from quilt.backup import Backup
+from quilt.backup import Backup, Manifest
 from quilt.command import Command
-from quilt.db import Db, Series
+from quilt.db import Db, FileIndex, Series
 from quilt.error import QuiltError, NoAppliedPatch
 from quilt.signals import Signal
 from quilt.utils import Directory, File
@@ -29,7 +29,12 @@ class Add(Command):
         self.quilt_pc = Directory(quilt_pc)
         self.quilt_patches = Directory(quilt_patches)
         self.db = Db(quilt_pc)
-        self.series = Series(quilt_patches)
+        self.file_index = FileIndex(self.db)
+        self.series = Series(quilt_patches, self.quilt_pc + ".cache")
+        # manifests by patch name and whether the file index has been
+        # changed since the last call of _save
+        self._manifests = dict()
+        self._index_changed = False
 
     def _file_in_patch(self, filename, patch, ignore):
         """ Checks if a backup file of the filename in the current patch
@@ -51,13 +56,13 @@ class Add(Command):
             # no paches applied
             return
 
-        patches = self.db.patches_after(patch)
-        for patch in patches:
-            file = self.quilt_pc + File(os.path.join(patch.get_name(),
-                                                     filename))
-            if file.exists():
-                raise QuiltError("File %s is already modified by patch %s" %
-                                 (filename, patch.get_name()))
+        if not self.file_index.valid:
+            self.file_index.build()
+            self.file_index.save()
+        patches = self.file_index.patches_after(filename, patch.get_name())
+        if patches:
+            raise QuiltError("File %s is already modified by patch %s" %
+                             (filename, patches[0]))
 
     def _backup_file(self, file, patch):
         """ Creates a backup of file """
@@ -69,12 +74,26 @@ class Add(Command):
         backup = Backup()
         backup.backup_file(file, dest_dir, copy_empty=True)
 
-    def add_file(self, filename, patch_name=None, ignore=False):
-        """ Add file to the patch with patch_name.
-        If patch_name is None or empty the topmost patch will be used.
-        Adding an already added patch will raise an QuiltError if ignore is
-        False.
-        """
+    def _get_manifest(self, patch):
+        """ Returns the Manifest of patch or None if it doesn't exist """
+        name = patch.get_name()
+        if name not in self._manifests:
+            manifest = Manifest(self.quilt_pc, name)
+            self._manifests[name] = manifest.read() and manifest or None
+        return self._manifests[name]
+
+    def _save(self):
+        """ Writes the manifests and the file index changed by the added
+        files """
+        for manifest in self._manifests.values():
+            if manifest:
+                manifest.save()
+        self._manifests.clear()
+        if self._index_changed:
+            self.file_index.save()
+            self._index_changed = False
+
+    def _add_file(self, filename, patch_name, ignore):
         file = File(filename)
 
         if patch_name:
@@ -99,8 +118,31 @@ class Add(Command):
             # be sure user can write original file
             os.chmod(filename, file.get_mode() | stat.S_IWUSR | stat.S_IRUSR)
 
+        manifest = self._get_manifest(patch)
+        if manifest:
+            manifest.record(self.cwd, [filename])
+        if self.db.is_patch(patch):
+            self.file_index.add_file(patch.get_name(), filename)
+            self._index_changed = True
+
         self.file_added(file, patch)
 
+    def add_file(self, filename, patch_name=None, ignore=False):
+        """ Add file to the patch with patch_name.
+        If patch_name is None or empty the topmost patch will be used.
+        Adding an already added patch will raise an QuiltError if ignore is
+        False.
+        """
+        try:
+            self._add_file(filename, patch_name, ignore)
+        finally:
+            self._save()
+
     def add_files(self, filenames, patch_name=None, ignore=False):
-        for filename in filenames:
-            self.add_file(filename, patch_name, ignore)
+        """ Adds several files like add_file. The manifest of the patch and
+        the file index are written only once. """
+        try:
+            for filename in filenames:
+                self._add_file(filename, patch_name, ignore)
+        finally:
+            self._save()
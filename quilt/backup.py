@@ -6,7 +6,296 @@
 #
 # See LICENSE comming with the source of python-quilt for details.
 
-from quilt.utils import File, DirectoryParam, FileParam
+import errno
+import hashlib
+import os
+import os.path
+import shutil
+import tempfile
+
+from quilt.utils import File, DirectoryParam, FileParam, copy_file, \
+                        _decode_str, _encode_str
+
+
+def _mtime_ns(st):
+    return getattr(st, "st_mtime_ns", int(st.st_mtime * 1000000000))
+
+
+def _file_signature(st):
+    """ Returns the size, mtime, ctime and inode of a stat result """
+    return (st.st_size, _mtime_ns(st),
+            getattr(st, "st_ctime_ns", int(st.st_ctime * 1000000000)),
+            st.st_ino)
+
+
+# signature of a file which doesn't exist
+MISSING = (-1, 0, 0, 0)
+
+# signature of a file which has been recorded before it has been written. It
+# never matches and the file is checked by its mtime and hash.
+UNKNOWN = (-2, 0, 0, 0)
+
+# size of the blocks to read for hashing files
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(f):
+    """ Returns the hex SHA-1 of the contents of the file object f """
+    digest = hashlib.sha1()
+    while True:
+        data = f.read(HASH_CHUNK_SIZE)
+        if not data:
+            break
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class ObjectStore(object):
+
+    """ Content addressed store for the backup files of the patches
+
+    Each distinct content is stored only once in the .objects directory of
+    the quilt pc directory. The backup files in the patch directories are
+    hard links to the objects, therefore the layout of the patch directories
+    stays the same and the backups can be read as usual. The store is only
+    used if the .objects directory exists.
+
+    Objects are identified by the SHA-1 of their content and their mode.
+    Backup files must never be modified in place. The objects linked into a
+    backup directory are listed in <backup dir>~objects by record. release
+    removes the listed objects which aren't referenced by any backup anymore.
+    collect checks all objects instead.
+    """
+
+    @DirectoryParam(["quilt_pc"])
+    def __init__(self, quilt_pc):
+        self.objects_dir = quilt_pc + ".objects"
+        # (backup, object) pairs linked since the last record
+        self.linked = []
+
+    def exists(self):
+        """ Returns True if the store is enabled """
+        return self.objects_dir.exists()
+
+    def create(self):
+        """ Enables the store """
+        self.objects_dir.create()
+
+    def _object_name(self, digest, mode):
+        name = "%s-%o" % (digest, mode & 0o7777)
+        return os.path.join(self.objects_dir.get_name(), name[:2], name[2:])
+
+    def _link(self, obj, dest):
+        dest_dir = os.path.dirname(dest)
+        if dest_dir and not os.path.exists(dest_dir):
+            os.makedirs(dest_dir)
+        if os.path.lexists(dest):
+            os.remove(dest)
+        try:
+            os.link(obj, dest)
+        except OSError as e:
+            if e.errno not in (errno.EMLINK, errno.EXDEV, errno.EPERM):
+                raise
+            # the file system doesn't allow more links
+            copy_file(obj, dest)
+        self.linked.append((dest, obj))
+
+    def _add(self, data, mode, dest, src=None):
+        obj = self._object_name(hashlib.sha1(data).hexdigest(), mode)
+        if not os.path.exists(obj):
+            obj_dir = os.path.dirname(obj)
+            if not os.path.exists(obj_dir):
+                os.makedirs(obj_dir)
+            fd, tmpname = tempfile.mkstemp(dir=obj_dir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            if src:
+                shutil.copystat(src, tmpname)
+            else:
+                os.chmod(tmpname, mode & 0o7777)
+            os.rename(tmpname, obj)
+        self._link(obj, dest)
+
+    def add_file(self, src, dest):
+        """ Creates dest as backup of the file src """
+        with open(src, "rb") as f:
+            data = f.read()
+        self._add(data, os.stat(src).st_mode, dest, src)
+
+    def add_data(self, data, mode, dest):
+        """ Creates dest as backup with the content data and mode """
+        self._add(data, mode, dest)
+
+    def _objects_file(self, backup_dir):
+        return backup_dir.get_name().rstrip(os.sep) + "~objects"
+
+    @DirectoryParam(["backup_dir"])
+    def record(self, backup_dir):
+        """ Adds the objects linked into backup_dir to its list of objects """
+        prefix = os.path.join(backup_dir.get_name(), "")
+        names = [os.path.relpath(obj, self.objects_dir.get_name())
+                 for dest, obj in self.linked if dest.startswith(prefix)]
+        self.linked = [(dest, obj) for dest, obj in self.linked
+                       if not dest.startswith(prefix)]
+        if not names:
+            return
+        with open(self._objects_file(backup_dir), "ab") as f:
+            f.write("".join([name + "\n" for name in names]).encode("ascii"))
+
+    @DirectoryParam(["backup_dir"])
+    def release(self, backup_dir):
+        """ Removes the objects listed for backup_dir which aren't referenced
+        by any backup anymore and the list. Must be called after the backups
+        in backup_dir have been deleted. """
+        self.record(backup_dir)
+        objects_file = self._objects_file(backup_dir)
+        try:
+            with open(objects_file, "rb") as f:
+                names = set(f.read().decode("ascii").split())
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        for name in names:
+            path = os.path.join(self.objects_dir.get_name(), name)
+            try:
+                if os.stat(path).st_nlink == 1:
+                    os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        os.remove(objects_file)
+
+    def collect(self):
+        """ Removes all objects not referenced by any backup file """
+        for dirpath, dirnames, filenames in os.walk(
+                self.objects_dir.get_name()):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if os.stat(path).st_nlink == 1:
+                    os.remove(path)
+
+
+class Manifest(object):
+
+    """ State of the files of an applied patch
+
+    The manifest is written when the patch is applied and stored next to the
+    backup directory of the patch in <pc>/<patch>~manifest. It contains the
+    mtime of the .timestamp file of the patch and the size, mtime, ctime,
+    inode and SHA-1 of each file of the patch. Files which don't exist are
+    recorded as MISSING without a hash. Files which are recorded from their
+    contents before they are written get the UNKNOWN signature.
+    """
+
+    @DirectoryParam(["quilt_pc"])
+    def __init__(self, quilt_pc, patch_name):
+        self.file = quilt_pc + File(patch_name + "~manifest")
+        self.timestamp_file = quilt_pc + File(os.path.join(patch_name,
+                                                           ".timestamp"))
+        self.timestamp = None
+        self.files = dict()
+        self.hashes = dict()
+
+    def exists(self):
+        return self.file.exists()
+
+    def read(self):
+        """ Reads the manifest. Returns False if it doesn't exist or can't be
+        parsed. """
+        self.timestamp = None
+        self.files = dict()
+        self.hashes = dict()
+        try:
+            with open(self.file.get_name(), "rb") as f:
+                lines = f.read().split(b"\n")
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        try:
+            self.timestamp = int(lines[0])
+            for line in lines[1:-1]:
+                fields = line.split(b" ", 5)
+                name = _decode_str(fields[5])
+                self.files[name] = tuple([int(field) for field in fields[:4]])
+                if fields[4] != b"-":
+                    self.hashes[name] = fields[4].decode("ascii")
+        except (ValueError, IndexError):
+            self.timestamp = None
+            self.files = dict()
+            self.hashes = dict()
+            return False
+        return True
+
+    @DirectoryParam(["cwd"])
+    def record(self, cwd, names):
+        """ Records the current state and contents of the files names in cwd
+        and the current mtime of the .timestamp file """
+        self.record_timestamp()
+        for name in names:
+            name = os.path.normpath(name)
+            try:
+                with open(os.path.join(cwd.get_name(), name), "rb") as f:
+                    self.files[name] = _file_signature(os.fstat(f.fileno()))
+                    self.hashes[name] = hash_file(f)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self.files[name] = MISSING
+                self.hashes.pop(name, None)
+
+    def record_data(self, name, data):
+        """ Records the contents data of the file name which will be written
+        later. data is None if the file will be removed. """
+        name = os.path.normpath(name)
+        if data is None:
+            self.files[name] = MISSING
+            self.hashes.pop(name, None)
+        else:
+            self.files[name] = UNKNOWN
+            self.hashes[name] = hashlib.sha1(data).hexdigest()
+
+    def record_timestamp(self):
+        """ Records the current mtime of the .timestamp file """
+        self.timestamp = _mtime_ns(os.stat(self.timestamp_file.get_name()))
+
+    def remove(self, name):
+        """ Removes the file name from the manifest """
+        self.files.pop(os.path.normpath(name), None)
+        self.hashes.pop(os.path.normpath(name), None)
+
+    def is_current(self):
+        """ Returns True if the .timestamp file of the patch hasn't been
+        touched since the manifest has been recorded """
+        try:
+            st = os.stat(self.timestamp_file.get_name())
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        return self.timestamp == _mtime_ns(st)
+
+    def save(self):
+        """ Writes the manifest atomically """
+        lines = [("%d\n" % self.timestamp).encode("ascii")]
+        for name_str, signature in sorted(self.files.items()):
+            name = _encode_str(name_str)
+            if b"\n" in name:
+                # can't be recorded, Pop falls back to check all backups
+                self.delete()
+                return
+            digest = self.hashes.get(name_str, "-").encode("ascii")
+            lines.append(("%d %d %d %d " % signature).encode("ascii") +
+                         digest + b" " + name + b"\n")
+        dirname = os.path.dirname(self.file.get_name())
+        fd, tmpname = tempfile.mkstemp(dir=dirname or None)
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"".join(lines))
+        os.rename(tmpname, self.file.get_name())
+
+    def delete(self):
+        self.file.delete_if_exists()
 
 
 class Backup(object):
@@ -60,7 +349,9 @@ class Backup(object):
 
     @DirectoryParam(["src_dir", "dest_dir"])
     def backup_dir(self, src_dir, dest_dir, copy_empty=False):
-        for file_name in src_dir.files():
+        for file_name, is_dir in src_dir.walk():
+            if is_dir:
+                continue
             file = File(file_name)
             file_dir = file.get_directory()
             if file_dir:
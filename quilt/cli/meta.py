@@ -14,7 +14,9 @@ import sys
 
 import quilt
 
-from quilt.db import Db, Series
+from quilt.db import Db, Series, set_durability
+from quilt.error import QuiltError
+from quilt.utils import set_copy_method
 
 from quilt.cli.parser import Parser, SubParser, ArgumentsCollectorMetaClass, \
                              Argument
@@ -73,7 +75,8 @@ class Command(SubParser):
         return Db(self.get_pc_dir())
 
     def get_series(self):
-        return Series(self.get_patches_dir())
+        return Series(self.get_patches_dir(),
+                      os.path.join(self.get_pc_dir(), ".cache"))
 
     def get_cwd(self):
         return os.getcwd()
@@ -111,6 +114,20 @@ class QuiltCli(Parser):
 
     def run(self):
         args = self.parse_args()
+        copy_method = os.environ.get("QUILT_BACKUP_METHOD")
+        if copy_method:
+            try:
+                set_copy_method(copy_method)
+            except QuiltError as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
+        durability = os.environ.get("QUILT_DURABILITY")
+        if durability:
+            try:
+                set_durability(durability)
+            except QuiltError as e:
+                print(e, file=sys.stderr)
+                sys.exit(1)
         if args.command:
             args.run(args)
         else:
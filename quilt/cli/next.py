@@ -8,7 +8,7 @@
 
 from quilt.cli.meta import Command
 from quilt.cli.parser import Argument
-from quilt.db import Db, Series
+from quilt.db import Db
 from quilt.patch import Patch
 
 
@@ -21,7 +21,7 @@ class NextCommand(Command):
     patch = Argument(nargs="?")
 
     def run(self, args):
-        series = Series(self.get_patches_dir())
+        series = self.get_series()
         if not series.exists():
             self.exit_error("No series file found.")
 
@@ -21,6 +21,9 @@ class PopCommand(Command):
     all = OptionArgument("-a", "--all", dest="all", action="store_true",
                          help="remove all applied patches")
 
+    jobs = OptionArgument("-j", "--jobs", dest="jobs", type=int,
+                          help="number of threads checking the patches "
+                          "before removing several patches")
     patch = Argument(nargs="?")
     #~ force
 
@@ -31,9 +34,9 @@ class PopCommand(Command):
         pop.empty_patch.connect(self.empty_patch)
 
         if args.all:
-            pop.unapply_all()
+            pop.unapply_all(jobs=args.jobs)
         elif args.patch:
-            pop.unapply_patch(args.patch)
+            pop.unapply_patch(args.patch, jobs=args.jobs)
         else:
             pop.unapply_top_patch()
 
@@ -8,7 +8,7 @@
 
 from quilt.cli.meta import Command
 from quilt.cli.parser import Argument
-from quilt.db import Series, Db
+from quilt.db import Db
 from quilt.patch import Patch
 
 
@@ -21,7 +21,7 @@ class PreviousCommand(Command):
     patch = Argument(nargs="?")
 
     def run(self, args):
-        series = Series(self.get_patches_dir())
+        series = self.get_series()
         db = Db(self.get_pc_dir())
 
         top = None
@@ -6,6 +6,8 @@
 #
 # See LICENSE comming with the source of python-quilt for details.
 
+import sys
+
 from quilt.cli.meta import Command
 from quilt.cli.parser import Argument, OptionArgument
 from quilt.push import Push
@@ -21,22 +23,56 @@ class PushCommand(Command):
     force = OptionArgument("-f", dest="force", action="store_true",
                            default=False,
                            help="Force apply, even if the patch has rejects.")
+    batch = OptionArgument("--batch", dest="batch", action="store_true",
+                           default=False,
+                           help="with -a apply the patches in memory and "
+                           "write each modified file only once")
+    prefetch = OptionArgument("--prefetch", dest="prefetch", type=int,
+                              default=0, metavar="N",
+                              help="with -a read and parse up to N following "
+                              "patches in the background")
+    object_store = OptionArgument("--object-store", dest="object_store",
+                                  action="store_true", default=False,
+                                  help="store the backups of the patches "
+                                  "deduplicated in the .objects directory of "
+                                  "the pc directory")
+    check = OptionArgument("--check", dest="check", action="store_true",
+                           default=False,
+                           help="check if all unapplied patches apply without "
+                           "modifying any file")
+    jobs = OptionArgument("-j", "--jobs", dest="jobs", type=int,
+                          help="number of processes used by --check")
     patch = Argument(nargs="?")
 
     def run(self, args):
         push = Push(self.get_cwd(), self.get_pc_dir(), self.get_patches_dir())
+        if args.object_store:
+            push.store.create()
         push.applying_patch.connect(self.applying_patch)
         push.applied.connect(self.applied)
         push.applied_empty_patch.connect(self.applied_empty_patch)
 
-        if args.all:
-            push.apply_all(args.force)
+        if args.check:
+            push.check_failed.connect(self.check_failed)
+            if push.check_all(args.jobs):
+                sys.exit(1)
+            print("All patches apply")
+        elif args.all:
+            push.apply_all(args.force, batch=args.batch,
+                           prefetch=args.prefetch)
         elif args.patch:
             # if patch doesn't have "patches/" prefix, add it; don't add it internally
             push.apply_patch(args.patch, args.force)
         else:
             push.apply_next_patch(args.force)
 
+    def check_failed(self, patch, hunks, error):
+        print("Patch %s does not apply" % patch.get_name())
+        if error:
+            print("  %s" % error)
+        for filename, result in hunks:
+            print("  %s: %s" % (filename, result))
+
     def applying_patch(self, patch):
         print("Applying patch %s" % patch.get_name())
 
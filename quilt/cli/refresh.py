@@ -22,6 +22,9 @@ class RefreshCommand(Command):
     edit = OptionArgument("-e", dest="edit", action="store_true",
                           default=False,
                           help="open patch in editor before refreshing")
+    jobs = OptionArgument("-j", "--jobs", dest="jobs", type=int, default=1,
+                          help="number of processes comparing the files of "
+                          "the patch")
     patch = Argument(nargs="?")
 
     def run(self, args):
@@ -33,7 +36,7 @@ class RefreshCommand(Command):
         if args.edit:
             refresh.edit_patch.connect(self.edit_patch)
 
-        refresh.refresh(args.patch, args.edit)
+        refresh.refresh(args.patch, args.edit, args.jobs)
 
     def edit_patch(self, tmpfile):
         editor = os.environ.get("EDITOR", "vi")
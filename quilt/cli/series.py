@@ -7,7 +7,6 @@
 # See LICENSE comming with the source of python-quilt for details.
 
 from quilt.cli.meta import Command
-from quilt.db import Series
 
 
 class SeriesCommand(Command):
@@ -16,6 +15,6 @@ class SeriesCommand(Command):
     help = "Print the names of all patches in the series file."
 
     def run(self, args):
-        series = Series(self.get_patches_dir())
+        series = self.get_series()
         for patch in series.patches():
             print(patch)
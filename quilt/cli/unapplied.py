@@ -7,7 +7,7 @@
 # See LICENSE comming with the source of python-quilt for details.
 
 from quilt.cli.meta import Command
-from quilt.db import Db, Series
+from quilt.db import Db
 
 
 class UnappliedCommand(Command):
@@ -18,7 +18,7 @@ class UnappliedCommand(Command):
     def run(self, args):
         db = Db(self.get_pc_dir())
         top = db.top_patch()
-        series = Series(self.get_patches_dir())
+        series = self.get_series()
         if top is None:
             patches = series.patches()
         else:
@@ -6,18 +6,26 @@
 #
 # See LICENSE comming with the source of python-quilt for details.
 
-from __future__ import print_function
-
-import getopt
+import hashlib
+import os
 import os.path
 import six
-import sys
+import time
+import weakref
+
+from six.moves import intern
 
 from quilt.error import QuiltError, UnknownPatch
-from quilt.patch import Patch
+from quilt.patch import Patch, _is_meta_data_cache, _load_pickle, \
+                        _stat_signature, _store_pickle, _write_fd
+from quilt.utils import Directory, DirectoryParam, File, _encode_str
 
 DB_VERSION = 2
 
+# policies for syncing the journal of the applied patches to disk
+DURABILITY_POLICIES = ["none", "batch", "strict"]
+_durability = "batch"
+
 
 class DBError(QuiltError):
     pass
@@ -27,9 +35,11 @@ class PatchLine(object):
 
     """ Represents a line in a series files """
 
+    __slots__ = ("line", "_comment", "patch")
+
     def __init__(self, patch):
         """ patch can be either a string or a Patch object """
-        self.comment = ""
+        self._comment = ""
         self.patch = None
         self.line = ""
         if isinstance(patch, six.string_types):
@@ -41,69 +51,141 @@ class PatchLine(object):
     def _parse_line(self, line):
         line = line.rstrip("\r\n")
         self.line = line
+        # the comment is split off on demand
+        self._comment = None
 
-        if line.rstrip().startswith("#"):
-            self.comment = line
-            return
-
-        if not line.strip():
-            # empty line
-            return
-
-        if "#" in line:
-            patchline, self.comment = line.split("#", 1)
-        else:
-            patchline = line
-
-        patchline = patchline.strip()
+        patchline = line.split("#", 1)[0].strip()
         if not patchline:
+            # empty or comment line
             return
 
-        patch_args = None
-        strip = 1
-        reverse = False
-
+        options = None
         if " " in patchline:
-            patch_name, patch_args = patchline.split(" ", 1)
+            patch_name, options = patchline.split(" ", 1)
         else:
             patch_name = patchline
-
-        if patch_args:
-            patch_args = patch_args.split()
-            try:
-                opts, args = getopt.getopt(patch_args, "p:R", ["strip=",
-                                                               "reverse"])
-                for o, a in opts:
-                    if o in ["-p", "--strip"]:
-                        strip = a
-                    elif o in ["-R", "--reverse"]:
-                        reverse = True
-            except getopt.GetoptError as err:
-                print(err, file=sys.stderr)
-
-        self.patch = Patch(patch_name, strip, reverse)
+        self.patch = _get_patch(patch_name, options)
+        if line == patch_name:
+            # share the interned name
+            self.line = self.patch.get_name()
 
     def get_patch(self):
         return self.patch
 
     def get_comment(self):
-        return self.comment
+        if self._comment is None:
+            if self.line.startswith("#"):
+                self._comment = self.line
+            elif "#" in self.line:
+                self._comment = self.line.split("#", 1)[1]
+            else:
+                self._comment = ""
+        return self._comment
 
     def set_comment(self, comment):
-        self.comment = comment
+        self._comment = comment
 
     def __str__(self):
         return self.line
 
 
+# Patch objects of the lines of the series files by name. Lines of the series
+# and applied-patches files share the same Patch if the options are equal.
+_patches = weakref.WeakValueDictionary()
+
+
+def _get_patch(patch_name, options):
+    """ Returns the interned Patch for patch_name and options """
+    patch_name = intern(patch_name)
+    if options:
+        # most series files use the same few options for all patches
+        options = intern(options)
+    patch = _patches.get(patch_name)
+    if patch is None:
+        patch = Patch(patch_name, options=options)
+        _patches[patch_name] = patch
+    elif patch.options != options:
+        patch = Patch(patch_name, options=options)
+    return patch
+
+
 class PatchSeries(object):
 
-    def __init__(self, dirname, filename):
+    """ List of patches read from a file
+
+    If cache_dir is set a snapshot of the parsed file is stored there once
+    its parent directory contains the .version file of the quilt meta-data.
+    It is used instead of parsing the file again as long as the size and
+    mtime of the file don't change.
+    """
+
+    # see PatchCache.racy_seconds
+    racy_seconds = 2
+
+    @DirectoryParam(["cache_dir"])
+    def __init__(self, dirname, filename, cache_dir=None):
         self.dirname = dirname
         self.filename = filename
         self.series_file = os.path.join(dirname, filename)
+        self.cache_dir = cache_dir
         self.read()
 
+    def _snapshot_name(self):
+        key = _encode_str(os.path.abspath(self.series_file))
+        return hashlib.sha1(key).hexdigest()
+
+    def _read_snapshot(self, signature):
+        """ Loads the patchlines from the snapshot. Returns False if there is
+        no valid snapshot for signature. """
+        snapshot = _load_pickle((self.cache_dir + "series" +
+                                 File(self._snapshot_name())).get_name())
+        if not snapshot or snapshot[0] != signature:
+            return False
+        for line, patch_name, options in snapshot[1]:
+            patchline = PatchLine.__new__(PatchLine)
+            patchline.line = line
+            patchline._comment = None
+            patchline.patch = None
+            if patch_name is not None:
+                patchline.patch = _get_patch(patch_name, options)
+                if line == patch_name:
+                    patchline.line = patchline.patch.get_name()
+                self.patch2line[patchline.patch] = patchline
+                self.patch2index[patchline.patch] = len(self.patchlines)
+            self.patchlines.append(patchline)
+        return True
+
+    def _store_snapshot(self, signature):
+        if not _is_meta_data_cache(self.cache_dir):
+            # don't write into directories which aren't quilt meta-data
+            # directories
+            return
+        lines = []
+        for patchline in self.patchlines:
+            patch = patchline.get_patch()
+            if patch:
+                lines.append((patchline.line, patch.get_name(),
+                              patch.options))
+            else:
+                lines.append((patchline.line, None, None))
+        _store_pickle(self.cache_dir + "series",
+                      self._snapshot_name(), (signature, lines))
+
+    def _positions(self):
+        """ Returns a dict mapping the patches to their index in patchlines.
+        It is rebuilt after patchlines has been reordered. """
+        if self.patch2index is None:
+            self.patch2index = dict()
+            for index, patchline in enumerate(self.patchlines):
+                patch = patchline.get_patch()
+                if patch:
+                    self.patch2index[patch] = index
+        return self.patch2index
+
+    def _index(self, patch):
+        self._check_patch(patch)
+        return self._positions()[patch]
+
     def _check_patch(self, patch):
         if not self.is_patch(patch):
             raise UnknownPatch(self, patch)
@@ -116,10 +198,24 @@ class PatchSeries(object):
         """ Reads all patches from the series file """
         self.patchlines = []
         self.patch2line = dict()
-        if self.exists():
-            with open(self.series_file, "r") as f:
-                for line in f:
-                    self.add_patch(line)
+        self.patch2index = dict()
+        if not self.exists():
+            return
+
+        signature = None
+        if self.cache_dir:
+            st = os.stat(self.series_file)
+            if time.time() - st.st_mtime >= self.racy_seconds:
+                signature = _stat_signature(st)
+                if self._read_snapshot(signature):
+                    return
+
+        with open(self.series_file, "r") as f:
+            for line in f:
+                self.add_patch(line)
+
+        if signature:
+            self._store_snapshot(signature)
 
     def save(self):
         """ Saves current patches list in the series file """
@@ -134,6 +230,8 @@ class PatchSeries(object):
         patch = patchline.get_patch()
         if patch:
             self.patch2line[patch] = patchline
+            if self.patch2index is not None:
+                self.patch2index[patch] = len(self.patchlines)
         self.patchlines.append(patchline)
 
     def _add_patches(self, patches):
@@ -151,6 +249,7 @@ class PatchSeries(object):
             patchlines.append(patchline)
         patchlines.extend(self.patchlines)
         self.patchlines = patchlines
+        self.patch2index = None
 
     def add_patches(self, patches, after=None):
         """ Add a list of patches to the patches list """
@@ -166,13 +265,17 @@ class PatchSeries(object):
                 self.patch2line[patchline.get_patch()] = patchline
             patchlines.extend(self._patchlines_after(after))
             self.patchlines = patchlines
+            self.patch2index = None
 
     def remove_patch(self, patch):
         """ Remove a patch from the patches list """
-        self._check_patch(patch)
-        patchline = self.patch2line[patch]
+        index = self._index(patch)
         del self.patch2line[patch]
-        self.patchlines.remove(patchline)
+        del self.patchlines[index]
+        if index == len(self.patchlines):
+            del self.patch2index[patch]
+        else:
+            self.patch2index = None
 
     def top_patch(self):
         """ Returns the last patch from the patches list or None if the list
@@ -196,24 +299,13 @@ class PatchSeries(object):
                 line.get_patch()]
 
     def _patchlines_after(self, patch):
-        self._check_patch(patch)
-        patchline = self.patch2line[patch]
-        index = self.patchlines.index(patchline) + 1
-        if index >= len(self.patchlines):
-            return []
-        return self.patchlines[index:]
+        return self.patchlines[self._index(patch) + 1:]
 
     def _patchlines_before(self, patch):
-        self._check_patch(patch)
-        patchline = self.patch2line[patch]
-        index = self.patchlines.index(patchline)
-        return self.patchlines[:index]
+        return self.patchlines[:self._index(patch)]
 
     def _patchlines_until(self, patch):
-        self._check_patch(patch)
-        patchline = self.patch2line[patch]
-        index = self.patchlines.index(patchline) + 1
-        return self.patchlines[:index]
+        return self.patchlines[:self._index(patch) + 1]
 
     def patches_after(self, patch):
         """ Returns a list of patches after patch from the patches list """
@@ -224,9 +316,10 @@ class PatchSeries(object):
         """ Returns the patch followed by patch from the patches list or None if
         no patch after can be found.
         """
-        patches = self.patches_after(patch)
-        if patches:
-            return patches[0]
+        for index in range(self._index(patch) + 1, len(self.patchlines)):
+            next_patch = self.patchlines[index].get_patch()
+            if next_patch:
+                return next_patch
         return None
 
     def patches_before(self, patch):
@@ -238,9 +331,10 @@ class PatchSeries(object):
         """ Returns the patch before patch from the patches list or None if no
         patch before can be found.
         """
-        patches = self.patches_before(patch)
-        if patches:
-            return patches[-1]
+        for index in range(self._index(patch) - 1, -1, -1):
+            prev_patch = self.patchlines[index].get_patch()
+            if prev_patch:
+                return prev_patch
         return None
 
     def patches_until(self, patch):
@@ -265,15 +359,102 @@ class PatchSeries(object):
         """ Replace old_patch with new_patch
         The method only replaces the patch and doesn't change any comments.
         """
-        self._check_patch(old_patch)
-        old_patchline = self.patch2line[old_patch]
-        index = self.patchlines.index(old_patchline)
-        self.patchlines.pop(index)
+        index = self._index(old_patch)
+        old_patchline = self.patchlines[index]
         new_patchline = PatchLine(new_patch)
         new_patchline.set_comment(old_patchline.get_comment())
-        self.patchlines.insert(index, new_patchline)
+        self.patchlines[index] = new_patchline
         del self.patch2line[old_patch]
         self.patch2line[new_patch] = new_patchline
+        del self.patch2index[old_patch]
+        self.patch2index[new_patch] = index
+
+
+def set_durability(policy):
+    """ Sets the durability policy of the journal of applied patches """
+    global _durability
+    if policy not in DURABILITY_POLICIES:
+        raise DBError("Unknown durability policy %r. Supported policies are "
+                      "%s" % (policy, ", ".join(DURABILITY_POLICIES)))
+    _durability = policy
+
+
+class Journal(object):
+
+    """ Append-only log of the patches applied and unapplied since the
+    applied-patches file has been saved
+
+    Each record is a line of "+" or "-" followed by a space and the patch
+    name. durability is one of DURABILITY_POLICIES: "none" never syncs the
+    journal to disk, "batch" syncs after every batch_size records and "strict"
+    syncs after each record.
+    """
+
+    batch_size = 32
+
+    def __init__(self, filename, durability=None):
+        self.filename = filename
+        self.durability = durability or _durability
+        self.fd = None
+        self.unsynced = 0
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def append(self, op, patch_name):
+        """ Adds a record for patch_name. op is "+" for an applied patch and
+        "-" for an unapplied one. """
+        if self.fd is None:
+            dirname = os.path.dirname(self.filename)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self.fd = os.open(self.filename,
+                              os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        line = "%s %s\n" % (op, patch_name)
+        os.write(self.fd, line.encode("utf-8"))
+        self.unsynced += 1
+        if self.durability == "strict" or (self.durability == "batch" and
+                                           self.unsynced >= self.batch_size):
+            self.sync()
+
+    def sync(self):
+        """ Writes the records to disk unless the durability is "none" """
+        if self.fd is not None and self.unsynced and \
+                self.durability != "none":
+            os.fsync(self.fd)
+        self.unsynced = 0
+
+    def records(self):
+        """ Returns a list of (op, patch_name) tuples. An incomplete last
+        record is ignored. """
+        records = []
+        if not self.exists():
+            return records
+        with open(self.filename, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n") or line[1:2] != b" " or \
+                        line[:1] not in (b"+", b"-"):
+                    continue
+                records.append((line[:1].decode("ascii"),
+                                line[2:-1].decode("utf-8")))
+        return records
+
+    def clear(self):
+        """ Deletes the journal """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.unsynced = 0
+        if self.exists():
+            os.remove(self.filename)
+
+
+def _line_size(patchline):
+    return len(_encode_str(str(patchline))) + 1
+
+
+def _encode_lines(patchlines):
+    return b"".join([_encode_str(str(line) + "\n") for line in patchlines])
 
 
 class Db(PatchSeries):
@@ -286,7 +467,49 @@ class Db(PatchSeries):
         self.version_file = os.path.join(dirname, ".version")
         if os.path.exists(self.version_file):
             self.check_version(self.version_file)
-        super(Db, self).__init__(dirname, "applied-patches")
+        self.journal = Journal(os.path.join(dirname, ".journal"))
+        self._recording = False
+        super(Db, self).__init__(dirname, "applied-patches",
+                                 os.path.join(dirname, ".cache"))
+
+    def read(self):
+        """ Reads the applied patches and recovers the changes recorded in
+        the journal if the applied-patches file hasn't been saved after
+        them. """
+        self._recording = False
+        super(Db, self).read()
+        self._saved = list(self.patchlines)
+        self._saved_size = None
+        if self.exists():
+            size = sum([_line_size(line) for line in self.patchlines])
+            if size == os.path.getsize(self.series_file):
+                # the file can be updated in place
+                self._saved_size = size
+        records = self.journal.records()
+        if records:
+            for op, patch_name in records:
+                patch = Patch(patch_name)
+                if op == "+" and not self.is_patch(patch):
+                    super(Db, self).add_patch(patch)
+                elif op == "-" and self.is_patch(patch):
+                    super(Db, self).remove_patch(patch)
+            self.save()
+        self._recording = True
+
+    def add_patch(self, patch):
+        """ Add a patch to the applied patches and record it in the journal
+        """
+        super(Db, self).add_patch(patch)
+        if self._recording:
+            patch = PatchLine(patch).get_patch()
+            if patch:
+                self.journal.append("+", patch.get_name())
+
+    def remove_patch(self, patch):
+        """ Remove a patch from the applied patches and record it in the
+        journal """
+        super(Db, self).remove_patch(patch)
+        self.journal.append("-", patch.get_name())
 
     def _create_version(self, version_file):
         with open(version_file, "w") as f:
@@ -298,10 +521,74 @@ class Db(PatchSeries):
             os.makedirs(self.dirname)
         self._create_version(self.version_file)
 
+    def _update(self, sync):
+        """ Appends the patches added to or truncates the patches removed from
+        the end of the applied-patches file. Returns False if other changes
+        have been made. """
+        if self._saved_size is None:
+            return False
+        saved = self._saved
+        common = 0
+        for saved_line, line in zip(saved, self.patchlines):
+            if saved_line is not line:
+                break
+            common += 1
+        if common < len(saved) and common < len(self.patchlines):
+            # patches have been changed in the middle
+            return False
+
+        try:
+            fd = os.open(self.series_file, os.O_WRONLY)
+        except OSError:
+            return False
+        try:
+            size = self._saved_size
+            if os.fstat(fd).st_size != size:
+                # modified by someone else
+                return False
+            if common < len(saved):
+                size -= sum([_line_size(line) for line in saved[common:]])
+                os.ftruncate(fd, size)
+            elif common < len(self.patchlines):
+                data = _encode_lines(self.patchlines[common:])
+                os.lseek(fd, size, os.SEEK_SET)
+                _write_fd(fd, data)
+                size += len(data)
+            if sync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._saved_size = size
+        return True
+
+    def _rewrite(self, sync):
+        """ Replaces the applied-patches file atomically """
+        data = _encode_lines(self.patchlines)
+        tmpname = self.series_file + ".tmp"
+        fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            _write_fd(fd, data)
+            if sync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmpname, self.series_file)
+        self._saved_size = len(data)
+
     def save(self):
-        """ Create version file and save applied patches """
-        self.create()
-        super(Db, self).save()
+        """ Create version file and save applied patches
+
+        Patches added or removed at the end are appended to or truncated from
+        the applied-patches file. Otherwise the file is replaced. Afterwards
+        the journal isn't needed anymore.
+        """
+        if not os.path.exists(self.version_file):
+            self.create()
+        sync = self.journal.durability != "none" and self.journal.exists()
+        if not self._update(sync):
+            self._rewrite(sync)
+        self._saved = list(self.patchlines)
+        self.journal.clear()
 
     def applied_patches(self):
         """ Lists all applied patches """
@@ -321,11 +608,130 @@ class Db(PatchSeries):
                           "version %r" % (version, DB_VERSION))
 
 
+class FileIndex(object):
+
+    """ Index of the files backed up by the applied patches
+
+    Maps each file to the applied patches which contain a backup of it in
+    applied order. The index is stored in <pc>/.files together with the
+    applied patches it belongs to. It is only valid as long as these match
+    the applied patches of db. Commands which don't need to look up files
+    only keep a valid index up to date and delete an outdated one.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.directory = Directory(db.dirname)
+        self.filename = os.path.join(db.dirname, ".files")
+        self.valid = False
+        self.patches = []
+        self.patch_files = dict()
+        self.files = dict()
+        self.read()
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def read(self):
+        """ Reads the index. Returns False if it is missing or outdated. """
+        data = _load_pickle(self.filename)
+        names = [patch.get_name() for patch in self.db.applied_patches()]
+        self.valid = bool(data) and data[0] == names
+        self.patches = names
+        self._set_positions()
+        self.patch_files = dict()
+        self.files = dict()
+        if self.valid:
+            for name in names:
+                self._add_files(name, data[1].get(name, []))
+        return self.valid
+
+    def build(self):
+        """ Creates the index from the backup directories of the applied
+        patches """
+        self.patches = [patch.get_name() for patch in
+                        self.db.applied_patches()]
+        self._set_positions()
+        self.patch_files = dict()
+        self.files = dict()
+        for name in self.patches:
+            pc_dir = self.directory + name
+            self._add_files(name, [file for file, is_dir in pc_dir.walk()
+                                   if not is_dir and file != ".timestamp"])
+        self.valid = True
+
+    def _set_positions(self):
+        self.positions = dict([(name, i) for i, name in
+                               enumerate(self.patches)])
+
+    def _add_files(self, patch_name, files):
+        patch_files = self.patch_files.setdefault(patch_name, [])
+        for file in files:
+            file = os.path.normpath(file)
+            patch_files.append(file)
+            self.files.setdefault(file, []).append(patch_name)
+
+    def add_patch(self, patch_name, files):
+        """ Adds the applied patch patch_name backing up files on top """
+        if self.valid:
+            self.positions[patch_name] = len(self.patches)
+            self.patches.append(patch_name)
+            self._add_files(patch_name, files)
+
+    def remove_patch(self, patch_name):
+        """ Removes the unapplied patch patch_name """
+        if not self.valid:
+            return
+        if self.patches[-1] == patch_name:
+            self.patches.pop()
+            del self.positions[patch_name]
+        else:
+            self.patches.remove(patch_name)
+            self._set_positions()
+        for file in self.patch_files.pop(patch_name, []):
+            patches = self.files[file]
+            patches.remove(patch_name)
+            if not patches:
+                del self.files[file]
+
+    def add_file(self, patch_name, file):
+        """ Adds file backed up by the applied patch patch_name. Later
+        patches must not contain file. """
+        if self.valid:
+            self._add_files(patch_name, [file])
+
+    def remove_file(self, patch_name, file):
+        """ Removes file from the patch patch_name """
+        if not self.valid:
+            return
+        file = os.path.normpath(file)
+        if file in self.patch_files.get(patch_name, []):
+            self.patch_files[patch_name].remove(file)
+            self.files[file].remove(patch_name)
+            if not self.files[file]:
+                del self.files[file]
+
+    def patches_after(self, file, patch_name):
+        """ Returns the names of the applied patches after patch_name which
+        contain file """
+        patches = self.files.get(os.path.normpath(file), [])
+        position = self.positions.get(patch_name, -1)
+        return [name for name in patches if self.positions[name] > position]
+
+    def save(self):
+        """ Stores a valid index and deletes an outdated one """
+        if self.valid:
+            _store_pickle(self.directory, ".files",
+                          (self.patches, self.patch_files))
+        elif self.exists():
+            os.remove(self.filename)
+
+
 class Series(PatchSeries):
 
     """ Represents the series file of quilt which contains the patches to be
         applied
     """
 
-    def __init__(self, dirname):
-        super(Series, self).__init__(dirname, "series")
+    def __init__(self, dirname, cache_dir=None):
+        super(Series, self).__init__(dirname, "series", cache_dir)
@@ -29,7 +29,7 @@ class Delete(Command):
         self.quilt_pc = Directory(quilt_pc)
         self.quilt_patches = Directory(quilt_patches)
         self.db = Db(quilt_pc)
-        self.series = Series(quilt_patches)
+        self.series = Series(quilt_patches, self.quilt_pc + ".cache")
         self.pop = Pop(cwd, quilt_pc, quilt_patches)
 
     def _delete_patch(self, patch, remove=False, backup=False):
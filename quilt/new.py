@@ -24,7 +24,7 @@ class New(Command):
         self.quilt_pc = Directory(quilt_pc)
         self.quilt_patches = Directory(quilt_patches)
         self.db = Db(quilt_pc)
-        self.series = Series(quilt_patches)
+        self.series = Series(quilt_patches, self.quilt_pc + ".cache")
 
     def create(self, patchname):
         """ Adds a new patch with patchname to the queue
@@ -6,21 +6,841 @@
 #
 # See LICENSE comming with the source of python-quilt for details.
 
+from __future__ import print_function
+
+import bisect
+import calendar
+import errno
+import getopt
+import hashlib
+import io
+import itertools
 import os
 import os.path
+import re
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+from six.moves import cPickle as pickle
 
+from quilt.error import QuiltError
+from quilt.unidiff import unified_diff
 from quilt.utils import Process, DirectoryParam, File, FileParam, \
-                        SubprocessError
+                        SubprocessError, _decode_str, _encode_str
+
+DEV_NULL = "/dev/null"
+
+# default fuzz factor of GNU patch
+MAX_FUZZ = 2
+
+NO_NEWLINE_MARKER = b"\\ No newline at end of file\n"
+
+
+class PatchApplyError(QuiltError):
+
+    """ Raised if a patch or some of its hunks can't be applied """
+
+    def __init__(self, patch_name, failed):
+        self.patch_name = patch_name
+        # list of (filename, hunk number, Hunk) tuples
+        self.failed = failed
+
+    def __str__(self):
+        return "Patch %s does not apply (%d hunk(s) failed)" % \
+            (self.patch_name, len(self.failed))
+
+
+class UnsupportedPatchFormat(QuiltError):
+
+    """ Raised if a patch file contains diffs that are not in the unified
+    format, git extended headers which can't be applied in-process or no
+    diff at all """
+    pass
+
+
+class Hunk(object):
+
+    """ A hunk of a unified diff """
+
+    def __init__(self, old_start, old_len, new_start, new_len):
+        self.old_start = old_start
+        self.old_len = old_len
+        self.new_start = new_start
+        self.new_len = new_len
+        # lines of the hunk including the leading " ", "-" or "+". A line
+        # without a trailing newline has been followed by a "\ No newline at
+        # end of file" marker in the patch.
+        self.lines = []
+
+    def old_lines(self):
+        """ Returns the lines the hunk expects in the file """
+        return [line[1:] for line in self.lines if line[:1] in b" -"]
+
+    def new_lines(self):
+        """ Returns the lines the hunk puts into the file """
+        return [line[1:] for line in self.lines if line[:1] in b" +"]
+
+    def leading_context(self):
+        """ Returns the number of context lines before the first change """
+        count = 0
+        for line in self.lines:
+            if line[:1] != b" ":
+                break
+            count += 1
+        return count
+
+    def trailing_context(self):
+        """ Returns the number of context lines after the last change """
+        count = 0
+        for line in reversed(self.lines):
+            if line[:1] != b" ":
+                break
+            count += 1
+        return count
+
+    def reverse(self):
+        """ Returns a new Hunk which reverts the changes of this hunk """
+        hunk = Hunk(self.new_start, self.new_len, self.old_start, self.old_len)
+        swap = {b"-": b"+", b"+": b"-", b" ": b" "}
+        hunk.lines = [swap[line[:1]] + line[1:] for line in self.lines]
+        return hunk
+
+    def get_header(self):
+        """ Returns the @@ line of the hunk as bytes """
+        return _encode_str("@@ -%s +%s @@\n" % (
+            _format_range(self.old_start, self.old_len),
+            _format_range(self.new_start, self.new_len)))
+
+    def to_bytes(self):
+        """ Returns the hunk in unified diff format """
+        lines = [self.get_header()]
+        for line in self.lines:
+            lines.append(line)
+            if not line.endswith(b"\n"):
+                lines.append(b"\n")
+                lines.append(NO_NEWLINE_MARKER)
+        return b"".join(lines)
+
+
+def _format_range(start, length):
+    if length == 1:
+        return "%d" % start
+    return "%d,%d" % (start, length)
+
+
+class FilePatch(object):
+
+    """ The changes of a single file within a patch """
+
+    # like /dev/null a timestamp of the Epoch marks a missing file. Class
+    # attributes for FilePatch objects pickled by older versions.
+    old_missing = False
+    new_missing = False
+
+    def __init__(self, old_name, new_name, old_missing=False,
+                 new_missing=False):
+        self.old_name = old_name
+        self.new_name = new_name
+        self.old_missing = old_missing
+        self.new_missing = new_missing
+        self.hunks = []
+
+    def is_creation(self):
+        return self.old_name == DEV_NULL or self.old_missing
+
+    def is_deletion(self):
+        return self.new_name == DEV_NULL or self.new_missing
+
+    def reversed_names(self):
+        """ Returns a new FilePatch without hunks with the old and new file
+        swapped """
+        return FilePatch(self.new_name, self.old_name, self.new_missing,
+                         self.old_missing)
+
+    def reverse(self):
+        """ Returns a new FilePatch which reverts the changes """
+        file_patch = self.reversed_names()
+        file_patch.hunks = [hunk.reverse() for hunk in self.hunks]
+        return file_patch
+
+    def get_target(self, strip, exists):
+        """ Returns the name of the file to patch after stripping strip
+        leading path components or None if no file name is left.
+
+        exists is a callable returning True if a file name exists. Like GNU
+        patch an existing file with the fewest path components is preferred
+        if the old and new names differ.
+        """
+        names = []
+        for name, missing in ((self.old_name, self.old_missing),
+                              (self.new_name, self.new_missing)):
+            if name == DEV_NULL or missing:
+                continue
+            name = _strip_path(name, strip)
+            if name and name not in names:
+                names.append(name)
+        if not names:
+            return None
+
+        existing = [name for name in names if exists(name)]
+        if existing:
+            names = existing
+        elif self.is_creation():
+            return names[0]
+
+        return min(names, key=lambda name: (name.count("/"),
+                                            len(os.path.basename(name)),
+                                            len(name)))
+
+
+def _strip_path(name, strip):
+    """ Removes strip leading components from the path name like patch -p """
+    for i in range(strip):
+        index = name.find("/")
+        if index < 0:
+            return None
+        name = name[index + 1:].lstrip("/")
+    return name
+
+
+def _parse_file_name(line):
+    """ Extracts the file name from a "--- " or "+++ " header line """
+    name = line[4:].rstrip(b"\r\n")
+    if b"\t" in name:
+        name = name.split(b"\t", 1)[0]
+    return _decode_str(name.rstrip())
+
+
+_ISO_TIMESTAMP = re.compile(r"(\d+)-(\d+)-(\d+) (\d+):(\d+):(\d+)(?:\.\d*)?"
+                            r"(?: ?([+-])(\d\d):?(\d\d))?$")
+_CTIME_TIMESTAMP = re.compile(r"\w{3} (\w{3}) +(\d+) (\d+):(\d+):(\d+) "
+                              r"(\d+)$")
+_MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep",
+           "Oct", "Nov", "Dec"]
+
+
+def _is_epoch(line):
+    """ Returns True if the timestamp of a "--- " or "+++ " header line is
+    the Epoch. Like GNU patch this marks a missing file, e.g. in the output
+    of diff -N. Timestamps without a time zone are accepted in UTC and local
+    time.
+    """
+    line = line[4:].rstrip(b"\r\n")
+    if b"\t" not in line:
+        return False
+    timestamp = _decode_str(line.split(b"\t", 1)[1].strip())
+    match = _ISO_TIMESTAMP.match(timestamp)
+    if match:
+        fields = [int(value) for value in match.group(1, 2, 3, 4, 5, 6)]
+        sign, hours, minutes = match.group(7, 8, 9)
+    else:
+        match = _CTIME_TIMESTAMP.match(timestamp)
+        if not match or match.group(1) not in _MONTHS:
+            return False
+        fields = [int(match.group(6)), _MONTHS.index(match.group(1)) + 1] + \
+            [int(value) for value in match.group(2, 3, 4, 5)]
+        sign = None
+
+    try:
+        seconds = calendar.timegm(tuple(fields) + (0, 0, 0))
+    except ValueError:
+        return False
+    if sign:
+        offset = (int(hours) * 60 + int(minutes)) * 60
+        if sign == "-":
+            offset = -offset
+        return seconds - offset == 0
+    if seconds == 0:
+        return True
+    try:
+        return time.mktime(tuple(fields) + (0, 0, -1)) == 0
+    except (OverflowError, ValueError):
+        return False
+
+
+def _parse_range(value):
+    if b"," in value:
+        start, length = value.split(b",", 1)
+        return int(start), int(length)
+    return int(value), 1
+
+
+def _is_header_end(line):
+    return line.startswith(b"---") or line.startswith(b"Index:")
+
+
+# header of a hunk of a normal diff, e.g. "3,4c3"
+_NORMAL_HUNK = re.compile(br"\d+(,\d+)?[acd]\d+(,\d+)?\r?\n?$")
+
+# lines of the extended header of a git diff
+_GIT_HEADERS = (b"old mode ", b"new mode ", b"deleted file mode ",
+                b"new file mode ", b"rename from ", b"rename to ",
+                b"copy from ", b"copy to ", b"similarity index ",
+                b"dissimilarity index ", b"index ")
+
+# lines of the extended header of a git diff which change more than the
+# contents of the file
+_UNSUPPORTED_GIT_HEADERS = (b"old mode ", b"new mode ", b"rename from ",
+                            b"rename to ", b"copy from ", b"copy to ")
+
+
+class PatchReader(object):
+
+    """ Reads the unified diffs of a patch lazily
+
+    lines can be any iterable of lines e.g. a file opened in binary mode.
+    Only the hunk being parsed is kept in memory, so patch files of any size
+    can be processed.
+    """
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._next = None
+        # set if any line has been read
+        self._read = False
+
+    def _peek(self):
+        if self._next is None:
+            self._next = next(self._lines, b"")
+        return self._next
+
+    def _readline(self):
+        line = self._peek()
+        self._next = None
+        if line:
+            self._read = True
+        return line
+
+    def header(self):
+        """ Returns the header of the patch before the first diff as bytes.
+        Must be called before file_patches.
+        """
+        lines = []
+        while self._peek() and not _is_header_end(self._peek()):
+            lines.append(self._readline())
+        return b"".join(lines)
+
+    def _parse_hunk(self, line):
+        try:
+            ranges = line.split(b"@@")[1].split()
+            old_start, old_len = _parse_range(ranges[0][1:])
+            new_start, new_len = _parse_range(ranges[1][1:])
+        except (IndexError, ValueError):
+            raise QuiltError("Malformed hunk header %r" % line)
+
+        hunk = Hunk(old_start, old_len, new_start, new_len)
+        old = new = 0
+        while old < old_len or new < new_len:
+            cur = self._readline()
+            if not cur:
+                raise QuiltError("Unexpected end of patch in hunk %r" % line)
+            kind = cur[:1]
+            if kind in (b"\n", b"\r"):
+                # some mailers strip the space of empty context lines
+                cur = b" " + cur
+                kind = b" "
+            if kind == b"\\":
+                continue
+            if kind == b" ":
+                old += 1
+                new += 1
+            elif kind == b"-":
+                old += 1
+            elif kind == b"+":
+                new += 1
+            else:
+                raise QuiltError("Malformed line %r in hunk %r" % (cur, line))
+            hunk.lines.append(cur)
+            if self._peek()[:1] == b"\\":
+                hunk.lines[-1] = _strip_newline(hunk.lines[-1])
+                self._readline()
+        return hunk
+
+    def _hunks(self):
+        while self._peek().startswith(b"@@ "):
+            yield self._parse_hunk(self._readline())
+
+    def file_patches(self):
+        """ Generator of (FilePatch, hunks) tuples where hunks is a generator
+        of the Hunk objects of the file. hunks must be consumed before the
+        next tuple is requested; hunks not consumed are skipped.
+
+        Raises UnsupportedPatchFormat for diffs that GNU patch applies
+        differently, i.e. other than unified diffs and git diffs which rename,
+        copy or change the mode of files, and if the patch isn't empty but
+        contains no diff at all.
+        """
+        found = False
+        # in the extended header of a git diff
+        git = False
+        while True:
+            line = self._readline()
+            if git and not line.startswith(b"--- "):
+                if not line.startswith(_GIT_HEADERS):
+                    # e.g. an empty new file or a binary diff
+                    raise UnsupportedPatchFormat("git diffs without changes "
+                                                 "of the contents are not "
+                                                 "supported")
+                if line.startswith(_UNSUPPORTED_GIT_HEADERS) or \
+                        line.startswith(b"new file mode ") and \
+                        not line.startswith(b"new file mode 100644"):
+                    raise UnsupportedPatchFormat("git diffs changing more "
+                                                 "than the contents of files "
+                                                 "are not supported")
+            if not line:
+                if self._read and not found:
+                    raise UnsupportedPatchFormat("Only garbage was found in "
+                                                 "the patch input")
+                return
+            if line.startswith(b"diff --git "):
+                git = True
+            elif _NORMAL_HUNK.match(line) and self._peek()[:2] in (b"< ",
+                                                                   b"> "):
+                raise UnsupportedPatchFormat("Only unified diffs are "
+                                             "supported")
+            if line.startswith(b"--- ") and self._peek().startswith(b"+++ "):
+                found = True
+                git = False
+                new_line = self._readline()
+                file_patch = FilePatch(_parse_file_name(line),
+                                       _parse_file_name(new_line),
+                                       _is_epoch(line), _is_epoch(new_line))
+                hunks = self._hunks()
+                yield file_patch, hunks
+                for hunk in hunks:
+                    pass
+            elif line.startswith(b"*** ") and self._peek().startswith(b"--- "):
+                raise UnsupportedPatchFormat("Only unified diffs are "
+                                             "supported")
+
+
+class PatchParser(object):
+
+    """ Parses the unified diffs of a patch file into memory """
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def file_patches(self):
+        """ Returns a list of FilePatch objects """
+        file_patches = []
+        for file_patch, hunks in PatchReader(self.lines).file_patches():
+            file_patch.hunks = list(hunks)
+            file_patches.append(file_patch)
+        return file_patches
+
+    def header_size(self):
+        """ Returns the size in bytes of the header before the first diff """
+        return len(PatchReader(self.lines).header())
+
+
+def _strip_newline(line):
+    if line.endswith(b"\r\n"):
+        return line[:-2]
+    if line.endswith(b"\n"):
+        return line[:-1]
+    return line
+
+
+def _stat_signature(st):
+    """ Returns a tuple to detect modifications of a file from its stat """
+    return (st.st_size, getattr(st, "st_mtime_ns", st.st_mtime))
+
+
+def _load_pickle(filename):
+    """ Returns the unpickled contents of a cache file or None """
+    try:
+        with open(filename, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        # missing or broken cache entry
+        return None
+
+
+def _store_pickle(directory, name, value):
+    """ Pickles value into the cache file name in directory atomically """
+    try:
+        directory.create()
+        fd, tmpname = tempfile.mkstemp(dir=directory.get_name())
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, (directory + File(name)).get_name())
+    except (IOError, OSError):
+        # caching is optional
+        pass
+
+
+def _is_meta_data_cache(cache_dir):
+    """ Returns True if cache_dir is located in a quilt meta-data directory.
+    Caches must not be written into other directories. """
+    pc_dir = os.path.dirname(cache_dir.get_name().rstrip(os.sep))
+    return os.path.exists(os.path.join(pc_dir, ".version"))
+
+
+def _remove_pickle(directory, name):
+    """ Removes the cache file name in directory if it exists """
+    try:
+        os.remove((directory + File(name)).get_name())
+    except OSError:
+        pass
+
+
+class PatchCache(object):
+
+    """ Persistent cache of parsed patch files
+
+    The parse results are stored by the SHA-1 of the patch file contents.
+    Additionally the size and mtime of each patch file is remembered so
+    unchanged patch files don't need to be read and hashed at all. Only the
+    parse result of the current contents of each patch file is kept. Nothing
+    is stored before the quilt meta-data directory has been created.
+    """
+
+    # patch files modified less than this many seconds before they got
+    # cached are always verified by their hash. Their mtime may not change
+    # on further modifications on file systems with coarse timestamps.
+    racy_seconds = 2
+
+    # bigger patch files are not cached but read lazily
+    max_size = 32 * 1024 * 1024
+
+    @DirectoryParam(["cache_dir"])
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.stat_dir = cache_dir + "stat"
+        self.parsed_dir = cache_dir + "parsed"
+        # results of prefetch by path; each one is used only once
+        self.prefetched = dict()
+
+    def _stat_file(self, path):
+        key = hashlib.sha1(_encode_str(os.path.abspath(path))).hexdigest()
+        return (self.stat_dir + File(key)).get_name()
+
+    def _parse(self, path):
+        st = os.stat(path)
+        signature = _stat_signature(st)
+        entry = self.prefetched.pop(path, None)
+        if entry and entry[0] == signature:
+            return entry[1]
+        stat_file = self._stat_file(path)
+        entry = _load_pickle(stat_file)
+        if entry and entry[0] == signature:
+            parsed = _load_pickle((self.parsed_dir +
+                                   File(entry[1])).get_name())
+            if parsed is not None:
+                return parsed
+
+        with open(path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        parsed = _load_pickle((self.parsed_dir + File(digest)).get_name())
+        store = _is_meta_data_cache(self.cache_dir)
+        if parsed is None:
+            parser = PatchParser(io.BytesIO(data).readlines())
+            try:
+                file_patches = parser.file_patches()
+            except UnsupportedPatchFormat:
+                file_patches = None
+            parsed = (parser.header_size(), file_patches)
+            if store:
+                _store_pickle(self.parsed_dir, digest, parsed)
+
+        if entry and entry[1] != digest:
+            # the patch file has been changed, its previous parse result
+            # isn't needed anymore
+            _remove_pickle(self.parsed_dir, entry[1])
+        if time.time() - st.st_mtime < self.racy_seconds:
+            # only remember the digest for pruning
+            signature = None
+        if store and (not entry or entry != (signature, digest)):
+            _store_pickle(self.stat_dir, os.path.basename(stat_file),
+                          (signature, digest))
+        return parsed
+
+    def prefetch(self, path):
+        """ Parses the patch file path ahead of time, e.g. in another thread.
+        The result is kept in memory for the next lookup of path as long as
+        the file is unchanged. Returns the list of FilePatch objects or None
+        if the file isn't a unified diff.
+        """
+        signature = _stat_signature(os.stat(path))
+        parsed = self._parse(path)
+        self.prefetched[path] = (signature, parsed)
+        return parsed[1]
+
+    def get_file_patches(self, path):
+        """ Returns the list of FilePatch objects of the patch file path """
+        file_patches = self._parse(path)[1]
+        if file_patches is None:
+            raise UnsupportedPatchFormat("Only unified diffs are supported")
+        return file_patches
+
+    def get_header_size(self, path):
+        """ Returns the size of the header of the patch file path """
+        return self._parse(path)[0]
+
+
+class HunkResult(object):
+
+    """ Describes where a hunk has been applied """
+
+    def __init__(self, number, hunk, line=None, offset=0, fuzz=0):
+        self.number = number
+        # the hunk is only available if it failed
+        self.hunk = hunk
+        # line number the hunk has been applied at or None if it failed
+        self.line = line
+        self.offset = offset
+        self.fuzz = fuzz
+
+    def failed(self):
+        return self.line is None
+
+    def mismatch(self):
+        """ Returns True if the hunk didn't apply at the expected position """
+        return self.failed() or self.offset != 0 or self.fuzz != 0
+
+    def __str__(self):
+        if self.failed():
+            line = self.hunk.old_start
+            if not self.hunk.old_len:
+                line += 1
+            return "Hunk #%d FAILED at %d." % (self.number, line)
+        msg = "Hunk #%d succeeded at %d" % (self.number, self.line)
+        if self.fuzz:
+            msg += " with fuzz %d" % self.fuzz
+        if self.offset:
+            msg += " (offset %d line%s)" % (self.offset,
+                                            abs(self.offset) != 1 and "s"
+                                            or "")
+        return msg + "."
+
+
+def _matches(lines, pattern, pos):
+    return lines[pos:pos + len(pattern)] == pattern
+
+
+class LineIndex(object):
+
+    """ Index of the positions of each line in a list of lines
+
+    It allows to find the position of a pattern of lines nearest to an
+    expected position without scanning the lines.
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.positions = None
+
+    def _build(self):
+        positions = dict()
+        for pos, line in enumerate(self.lines):
+            positions.setdefault(line, []).append(pos)
+        self.positions = positions
+
+    def find(self, pattern, expected, min_pos, max_pos):
+        """ Returns the position of pattern between min_pos and max_pos which
+        is nearest to expected or None. If two positions have the same
+        distance the one after expected is returned like GNU patch does.
+        """
+        if self.positions is None:
+            self._build()
+
+        # use the least frequent line of the pattern as anchor
+        anchor = None
+        for i, line in enumerate(pattern):
+            positions = self.positions.get(line)
+            if not positions:
+                return None
+            if anchor is None or len(positions) < len(anchor[1]):
+                anchor = (i, positions)
+                if len(positions) == 1:
+                    break
+
+        offset, positions = anchor
+        lines = self.lines
+        after = bisect.bisect_left(positions, expected + offset)
+        before = after - 1
+        while True:
+            cand_after = cand_before = None
+            if after < len(positions):
+                cand_after = positions[after] - offset
+                if cand_after > max_pos:
+                    cand_after = None
+            if before >= 0:
+                cand_before = positions[before] - offset
+                if cand_before < min_pos:
+                    cand_before = None
+            if cand_after is None and cand_before is None:
+                return None
+            if cand_before is None or (cand_after is not None and
+                                       cand_after - expected <=
+                                       expected - cand_before):
+                pos = cand_after
+                after += 1
+            else:
+                pos = cand_before
+                before -= 1
+            if pos >= min_pos and _matches(lines, pattern, pos):
+                return pos
+
+
+def _locate(lines, index, pattern, expected, min_pos, at_end):
+    """ Searches pattern in lines nearest to position expected like GNU patch
+    does. index is a LineIndex of lines. Returns the position or None.
+    """
+    max_pos = len(lines) - len(pattern)
+    if at_end:
+        if max_pos >= min_pos and _matches(lines, pattern, max_pos):
+            return max_pos
+        return None
+
+    if min_pos <= expected <= max_pos and _matches(lines, pattern, expected):
+        return expected
+    if max_pos < min_pos:
+        return None
+    return index.find(pattern, expected, min_pos, max_pos)
+
+
+def apply_hunks(lines, hunks, max_fuzz=MAX_FUZZ):
+    """ Applies hunks to a list of lines (bytes including line endings).
+
+    Returns a tuple of the resulting list of lines and a list of HunkResult
+    objects. Failed hunks are left out of the result.
+    """
+    result = []
+    hunk_results = []
+    pos = 0
+    last_offset = 0
+    # positions of added lines without a trailing newline
+    unterminated = []
+    index = LineIndex(lines)
+
+    for number, hunk in enumerate(hunks, 1):
+        old = hunk.old_lines()
+        new = hunk.new_lines()
+        leading = hunk.leading_context()
+        trailing = hunk.trailing_context()
+        context = max(leading, trailing)
+
+        if hunk.old_len:
+            expected = hunk.old_start - 1
+        else:
+            expected = hunk.old_start
+
+        found = None
+        if not old:
+            # an empty range matches always
+            if pos <= expected + last_offset <= len(lines):
+                found = (expected + last_offset, 0, 0, 0)
+        else:
+            for fuzz in range(min(max_fuzz, context) + 1):
+                # a hunk with less leading than trailing context (or vice
+                # versa) belongs to the start (end) of the file unless enough
+                # fuzz is allowed
+                prefix = fuzz + leading - context
+                suffix = fuzz + trailing - context
+                at_start = prefix < 0 and expected == 0
+                at_end = suffix < 0
+                prefix = max(prefix, 0)
+                suffix = max(suffix, 0)
+                pattern = old[prefix:len(old) - suffix]
+                if at_start:
+                    # like GNU patch the leading context may overlap the
+                    # lines changed by previous hunks here. A hunk which
+                    # belongs to both ends must match the whole file.
+                    where = None
+                    if pos <= leading and (not at_end or
+                                           len(old) == len(lines)) and \
+                            _matches(lines, pattern, 0):
+                        where = 0
+                else:
+                    # the hunk including the fuzzy leading context lines
+                    # must start after the lines changed by previous hunks.
+                    # It may overlap with their trailing context.
+                    where = _locate(lines, index, pattern,
+                                    expected + last_offset + prefix,
+                                    pos + prefix, at_end)
+                if where is not None:
+                    found = (where, fuzz, prefix, suffix)
+                    break
+
+        if found is None:
+            hunk_results.append(HunkResult(number, hunk))
+            continue
+
+        where, fuzz, prefix, suffix = found
+        # only copy the lines between the leading and trailing context to
+        # keep fuzzy context lines of the file
+        start = where + leading - prefix
+        result.extend(lines[pos:start])
+        result.extend(new[leading:len(new) - trailing])
+        if result and not result[-1].endswith(b"\n"):
+            unterminated.append(len(result) - 1)
+        pos = where + len(old) - prefix - suffix - (trailing - suffix)
+        last_offset = where - prefix - expected
+        # don't keep applied hunks to save memory with huge patches
+        hunk_results.append(HunkResult(number, None, where - prefix + 1,
+                                       last_offset, fuzz))
+
+    result.extend(lines[pos:])
+    for index in unterminated:
+        # lines in the middle of the file always end with a newline
+        if index < len(result) - 1:
+            result[index] += b"\n"
+    return result, hunk_results
 
 
 class Patch(object):
 
-    """ Wrapper arround the patch util """
+    """ Wrapper arround the patch util
+
+    options is the string of patch options from a series file. It is only
+    parsed when strip or reverse is accessed.
+    """
 
-    def __init__(self, patch_name, strip=1, reverse=False):
+    __slots__ = ("patch_name", "options", "_strip", "_reverse",
+                 "__weakref__")
+
+    def __init__(self, patch_name, strip=1, reverse=False, options=None):
         self.patch_name = patch_name
-        self.strip = strip
-        self.reverse = reverse
+        self.options = options
+        self._strip = strip
+        self._reverse = reverse
+        if options:
+            # parsed on demand
+            self._strip = None
+
+    def _parse_options(self):
+        strip = 1
+        reverse = False
+        try:
+            opts, args = getopt.getopt(self.options.split(), "p:R",
+                                       ["strip=", "reverse"])
+            for o, a in opts:
+                if o in ["-p", "--strip"]:
+                    strip = a
+                elif o in ["-R", "--reverse"]:
+                    reverse = True
+        except getopt.GetoptError as err:
+            print(err, file=sys.stderr)
+        self._strip = strip
+        self._reverse = reverse
+
+    @property
+    def strip(self):
+        if self._strip is None and self.options:
+            self._parse_options()
+        return self._strip
+
+    @property
+    def reverse(self):
+        if self._strip is None and self.options:
+            self._parse_options()
+        return self._reverse
 
     @DirectoryParam(["patch_dir", "work_dir"])
     def run(self, cwd, patch_dir=None, backup=False, prefix=None,
@@ -72,26 +892,113 @@ class Patch(object):
 
         Process(cmd).run(cwd=cwd)
 
+    @DirectoryParam(["patch_dir", "work_dir"])
+    def apply(self, cwd, patch_dir=None, backup=False, prefix=None,
+              reverse=False, work_dir=None, force=False, dry_run=False,
+              no_backup_if_mismatch=False, remove_empty_files=False,
+              quiet=False, cache=None, store=None):
+        """ Applies the patch without running the patch util.
+
+        The arguments correspond to the ones of run. If the patch can't be
+        applied completely a PatchApplyError is raised after all applicable
+        hunks have been applied and rejects have been saved. cache may be a
+        PatchCache to look up the parsed patch file. The backups are added to
+        the ObjectStore store if it isn't None.
+        """
+        # the messages are only printed if the patch can be applied in-process
+        applier = PatchApplier(cwd, work_dir, backup, prefix, force,
+                               dry_run, no_backup_if_mismatch,
+                               remove_empty_files, quiet, buffered=True,
+                               store=store)
+        try:
+            for file_patch, hunks in self.read_file_patches(
+                    cwd, patch_dir, cache, reverse != self.reverse):
+                applier.apply(file_patch, self.get_strip(), hunks)
+        except UnsupportedPatchFormat:
+            # only backups have been written so far. They are removed to let
+            # the patch util create them from the unchanged files.
+            applier.discard_backups()
+            return self.run(cwd, patch_dir=patch_dir, backup=backup,
+                            prefix=prefix, reverse=reverse,
+                            work_dir=work_dir, force=force, dry_run=dry_run,
+                            no_backup_if_mismatch=no_backup_if_mismatch,
+                            remove_empty_files=remove_empty_files,
+                            quiet=quiet)
+        applier.flush_messages()
+        applier.finish()
+
+        if applier.failed:
+            raise PatchApplyError(self.get_name(), applier.failed)
+
+    def _get_path(self, cwd, patch_dir):
+        if patch_dir:
+            name = (patch_dir + File(self.get_name())).get_name()
+        else:
+            name = self.get_name()
+        return os.path.join(cwd, name)
+
+    @DirectoryParam(["patch_dir"])
+    def read_file_patches(self, cwd, patch_dir=None, cache=None,
+                          reverse=False):
+        """ Generator of (FilePatch, hunks) tuples like
+        PatchReader.file_patches. If the patch file is small enough for
+        cache it is looked up there, otherwise it is read lazily. If reverse
+        is True the reversed changes are returned.
+        """
+        path = self._get_path(cwd, patch_dir)
+        if cache and os.path.getsize(path) <= cache.max_size:
+            items = [(file_patch, file_patch.hunks) for file_patch in
+                     cache.get_file_patches(path)]
+        else:
+            f = open(path, "rb")
+            items = PatchReader(f).file_patches()
+
+        try:
+            for file_patch, hunks in items:
+                if reverse:
+                    file_patch = file_patch.reversed_names()
+                    hunks = (hunk.reverse() for hunk in hunks)
+                yield file_patch, hunks
+        finally:
+            if not isinstance(items, list):
+                f.close()
+
+    @DirectoryParam(["patch_dir"])
+    def get_file_patches(self, cwd, patch_dir=None, cache=None):
+        """ Parses the patch file and returns a list of FilePatch objects.
+        Raises UnsupportedPatchFormat if the patch file contains other than
+        unified diffs. If cache is a PatchCache the parse result is looked up
+        there.
+        """
+        file_patches = []
+        for file_patch, hunks in self.read_file_patches(cwd, patch_dir,
+                                                        cache):
+            if not isinstance(hunks, list):
+                file_patch.hunks = list(hunks)
+            file_patches.append(file_patch)
+        return file_patches
+
     def get_name(self):
         return self.patch_name
 
+    def get_strip(self):
+        """ Returns the number of path components to strip as int """
+        if self.strip is None:
+            return 1
+        return int(self.strip)
+
     @DirectoryParam(["patch_dir"])
-    def get_header(self, patch_dir=None):
+    def get_header(self, patch_dir=None, cache=None):
         """ Returns bytes """
-        lines = []
-
         if patch_dir:
             file = patch_dir + File(self.get_name())
             name = file.get_name()
         else:
             name = self.get_name()
         with open(name, "rb") as f:
-            for line in f:
-                if line.startswith(b"---") or line.startswith(b"Index:"):
-                    break
-                lines.append(line)
-
-        return b"".join(lines)
+            if cache and os.path.getsize(name) <= cache.max_size:
+                return f.read(cache.get_header_size(name))
+            return PatchReader(f).header()
 
     def __eq__(self, other):
         return (isinstance(other, Patch) and self.get_name() ==
@@ -108,6 +1015,243 @@ class Patch(object):
                                                  self.reverse, id(self))
 
 
+class PatchApplier(object):
+
+    """ Applies FilePatch objects to the files in a directory and writes the
+    results in the same way as GNU patch does.
+
+    files may contain the current contents of files by name which are used
+    instead of the contents on disk. Messages are collected in messages
+    instead of being printed if buffered is True.
+    """
+
+    def __init__(self, cwd, work_dir=None, backup=False, prefix=None,
+                 force=False, dry_run=False, no_backup_if_mismatch=False,
+                 remove_empty_files=False, quiet=False, files=None,
+                 buffered=False, store=None):
+        self.dir = cwd
+        if work_dir:
+            self.dir = os.path.join(cwd, work_dir.get_name())
+        self.backup = backup
+        self.prefix = prefix
+        self.force = force
+        self.dry_run = dry_run
+        self.no_backup_if_mismatch = no_backup_if_mismatch
+        self.remove_empty_files = remove_empty_files
+        self.quiet = quiet
+        self.files = files or dict()
+        # ObjectStore for the backups
+        self.store = store
+        # patched contents by file name; None for removed files
+        self.contents = dict()
+        # contents before patching by file name; None for missing files
+        self.originals = dict()
+        self.messages = buffered and [] or None
+        self.backed_up = set()
+        # paths of the written backup files
+        self.backups = []
+        self.rejects = dict()
+        self.failed = []
+
+    def _path(self, name):
+        return os.path.join(self.dir, name)
+
+    def _exists(self, name):
+        if name in self.contents:
+            return self.contents[name] is not None
+        if name in self.files:
+            return self.files[name] is not None
+        return os.path.exists(self._path(name))
+
+    def _read(self, name):
+        """ Returns the current lines of the file name or None if the file
+        doesn't exist """
+        if name in self.contents:
+            return self.contents[name]
+        if name in self.files:
+            lines = self.files[name]
+        else:
+            path = self._path(name)
+            if not os.path.exists(path):
+                lines = None
+            else:
+                with open(path, "rb") as f:
+                    lines = f.readlines()
+        self.originals[name] = lines
+        return lines
+
+    def _message(self, msg):
+        if self.quiet:
+            return
+        if self.messages is not None:
+            self.messages.append(msg)
+        else:
+            sys.stdout.write(msg + "\n")
+            sys.stdout.flush()
+
+    def flush_messages(self):
+        """ Prints all buffered messages """
+        if self.messages:
+            sys.stdout.write("\n".join(self.messages) + "\n")
+            sys.stdout.flush()
+            self.messages = []
+
+    def apply(self, file_patch, strip, hunks=None):
+        """ Applies the changes of file_patch. hunks may be an iterable of
+        hunks to use instead of file_patch.hunks. """
+        if hunks is None:
+            hunks = file_patch.hunks
+        hunks = iter(hunks)
+        try:
+            first = next(hunks)
+        except StopIteration:
+            return
+        hunks = itertools.chain([first], hunks)
+
+        name = file_patch.get_target(strip, self._exists)
+        if name is None:
+            self._message("can't find file to patch")
+            self.failed.extend([(None, number, hunk) for number, hunk in
+                                enumerate(hunks, 1)])
+            return
+
+        lines = self._read(name) or []
+        if file_patch.is_creation() and lines:
+            self._message("The next patch would create the file %s,\n"
+                          "which already exists!" % name)
+            if not self.force:
+                self._message("Skipping patch.")
+                self.failed.extend([(name, number, hunk) for number, hunk in
+                                    enumerate(hunks, 1)])
+                return
+            results = [HunkResult(number, hunk) for number, hunk in
+                       enumerate(hunks, 1)]
+        else:
+            lines, results = apply_hunks(lines, hunks)
+
+        if self.dry_run:
+            self._message("checking file %s" % name)
+        else:
+            self._message("patching file %s" % name)
+
+        mismatch = False
+        for result in results:
+            if result.mismatch():
+                mismatch = True
+                self._message(str(result))
+            if result.failed():
+                self.failed.append((name, result.number, result.hunk))
+                self.rejects.setdefault(name, []).append(result.hunk)
+
+        self._backup(name, mismatch)
+        if file_patch.is_deletion() and not lines:
+            self.contents[name] = None
+        else:
+            self.contents[name] = lines
+
+        rejects = self.rejects.get(name)
+        if rejects:
+            self._message("%d out of %d hunk%s FAILED -- saving rejects to "
+                          "file %s" % (len(rejects), len(results),
+                                       len(results) != 1 and "s" or "",
+                                       name + ".rej"))
+
+    def _backup(self, name, mismatch):
+        if self.dry_run or name in self.backed_up:
+            return
+        if self.backup:
+            prefix = self.prefix
+            if prefix and prefix[-1] != os.sep:
+                prefix += os.sep
+            dest = os.path.join(self.dir, (prefix or "") + name)
+            if not self.prefix:
+                dest += ".orig"
+        elif mismatch and not self.no_backup_if_mismatch:
+            dest = self._path(name) + ".orig"
+        else:
+            return
+
+        self.backed_up.add(name)
+        self.backups.append(dest)
+        path = self._path(name)
+        if os.path.exists(path):
+            if self.store and self.backup:
+                self.store.add_file(path, dest)
+            else:
+                File(path).copy(File(dest))
+        else:
+            # remember that the file did not exist before
+            File(dest).get_directory().create()
+            File(dest).touch()
+
+    def write(self, name, lines):
+        """ Writes lines to the file name. The file is replaced atomically.
+        """
+        path = self._path(name)
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        fd, tmpname = tempfile.mkstemp(prefix=".pquilt-", dir=directory or
+                                       None)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.writelines(lines)
+            if os.path.exists(path):
+                shutil.copymode(path, tmpname)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmpname, 0o666 & ~umask)
+            os.rename(tmpname, path)
+        except Exception:
+            os.remove(tmpname)
+            raise
+
+    def remove(self, name):
+        """ Removes the file name and its parent directories if they became
+        empty """
+        path = self._path(name)
+        if os.path.exists(path):
+            os.remove(path)
+        # remove directories that became empty like GNU patch does
+        directory = os.path.dirname(name)
+        while directory:
+            try:
+                os.rmdir(self._path(directory))
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+    def discard_backups(self):
+        """ Removes the backup files written so far """
+        for dest in self.backups:
+            File(dest).delete_if_exists()
+        self.backups = []
+        self.backed_up.clear()
+
+    def finish(self):
+        """ Writes all patched files and rejects """
+        if self.dry_run:
+            return
+
+        for name, lines in self.contents.items():
+            if lines is None or (self.remove_empty_files and not lines):
+                self.remove(name)
+            else:
+                self.write(name, lines)
+
+        for name, hunks in self.rejects.items():
+            with open(self._path(name) + ".rej", "wb") as f:
+                f.write(b"--- " + _encode_str(name) + b"\n")
+                f.write(b"+++ " + _encode_str(name) + b"\n")
+                for hunk in hunks:
+                    f.write(hunk.to_bytes())
+
+
+# os.rename doesn't replace existing files on Windows
+_replace = getattr(os, "replace", os.rename)
+
+
 class RollbackPatch(object):
 
     @DirectoryParam(["cwd", "backup_dir"])
@@ -115,32 +1259,170 @@ class RollbackPatch(object):
         self.cwd = cwd
         self.backup_dir = backup_dir
 
-    def rollback(self, keep=False):
-        (dirs, files) = self.backup_dir.content()
+    def rollback(self, keep=False, move=False, files=None):
+        """ Restores the files from the backups. If keep is True files with
+        an empty backup are not deleted. files may be a list of names to only
+        restore some of the files.
+
+        If move is True the backup files are moved into place instead of
+        being copied. Only use it if the backups are deleted afterwards.
+        Backups on another file system or shared with an ObjectStore are
+        still copied.
+        """
+        if files is None:
+            entries = self.backup_dir.walk()
+        else:
+            dirs = set([os.path.dirname(file) for file in files])
+            dirs.discard("")
+            entries = [(dir, True) for dir in dirs]
+            entries.extend([(file, False) for file in files])
 
-        for dir in dirs:
-            newdir = self.cwd + dir
-            if not newdir.exists():
-                newdir.create()
+        for name, is_dir in entries:
+            if is_dir:
+                newdir = self.cwd + name
+                if not newdir.exists():
+                    newdir.create()
+                continue
 
-        for file in files:
-            file = File(file)
+            file = File(name)
             backup_file = self.backup_dir + file
             rollback_file = self.cwd + file
 
+            if backup_file.is_empty():
+                if not keep:
+                    rollback_file.delete_if_exists()
+                continue
+            if move and self._move(backup_file, rollback_file):
+                continue
             if not keep:
                 rollback_file.delete_if_exists()
-            if not backup_file.is_empty():
-                backup_file.copy(rollback_file)
+            backup_file.copy(rollback_file)
+
+    def _move(self, backup_file, rollback_file):
+        """ Moves backup_file to rollback_file atomically. Returns False if
+        the file has to be copied instead. """
+        if os.stat(backup_file.get_name()).st_nlink > 1:
+            # hard link of an object or of another file
+            return False
+        try:
+            _replace(backup_file.get_name(), rollback_file.get_name())
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            return False
+        return True
 
     def delete_backup(self):
+        """ Deletes the backups. Objects of an ObjectStore which aren't
+        referenced anymore are left for ObjectStore.collect. """
         self.backup_dir.delete()
 
 
+class DiffCache(object):
+
+    """ Persistent cache of the diffs of the files of a patch
+
+    The diff of each file is stored together with the size, mtime and inode
+    of the file and its backup. Files with unchanged stat don't need to be
+    compared again on the next refresh.
+    """
+
+    # see PatchCache.racy_seconds
+    racy_seconds = 2
+
+    @DirectoryParam(["cache_dir"])
+    def __init__(self, cache_dir, patch_name):
+        self.cache_dir = cache_dir
+        self.diff_dir = cache_dir + "diff"
+        self.key = hashlib.sha1(_encode_str(patch_name)).hexdigest()
+        self.entries = _load_pickle((self.diff_dir +
+                                     File(self.key)).get_name()) or dict()
+        self.new_entries = dict()
+
+    def get_signature(self, *paths):
+        """ Returns a tuple of the stat of the files in paths or None if one
+        of them has been modified too recently to trust its mtime """
+        now = time.time()
+        signature = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                signature.append(None)
+                continue
+            if now - st.st_mtime < self.racy_seconds:
+                return None
+            signature.append(_stat_signature(st) + (st.st_ino,))
+        return tuple(signature)
+
+    def get(self, name, signature):
+        """ Returns the cached diff of the file name or None if signature
+        doesn't match """
+        entry = self.entries.get(name)
+        if signature is None or not entry or entry[0] != signature:
+            return None
+        return entry[1]
+
+    def set(self, name, signature, data):
+        """ Remembers the diff data of the file name for save """
+        if signature is not None:
+            self.new_entries[name] = (signature, data)
+
+    def save(self):
+        """ Replaces the stored diffs by the ones set since loading """
+        if _is_meta_data_cache(self.cache_dir):
+            _store_pickle(self.diff_dir, self.key, self.new_entries)
+
+    def prune(self, patch_names):
+        """ Removes the stored diffs of all patches except patch_names, e.g.
+        of deleted or renamed patches """
+        keys = set([hashlib.sha1(_encode_str(name)).hexdigest() for name in
+                    patch_names])
+        keys.add(self.key)
+        try:
+            names = os.listdir(self.diff_dir.get_name())
+        except OSError:
+            return
+        for name in names:
+            # skip temporary files being written
+            if len(name) == 40 and name not in keys:
+                _remove_pickle(self.diff_dir, name)
+
+
+def _format_mtime(st):
+    """ Formats the modification time of a stat result like diff -u """
+    mtime_ns = getattr(st, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    seconds, nanoseconds = divmod(mtime_ns, 1000000000)
+    tm = time.localtime(seconds)
+    return _encode_str("%s.%09d %s" % (time.strftime("%Y-%m-%d %H:%M:%S", tm),
+                                       nanoseconds,
+                                       time.strftime("%z", tm)))
+
+
+def _write_fd(fd, data):
+    """ Writes data unbuffered to the file object or file descriptor fd or
+    to stdout if fd is None. """
+    if fd is None:
+        out = getattr(sys.stdout, "buffer", sys.stdout)
+        out.write(data)
+        out.flush()
+        return
+    if not isinstance(fd, int):
+        fd = fd.fileno()
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
 class Diff(object):
     """ Wrapper arround the diff util
     """
 
+    # number of bytes compared at once by equal
+    chunk_size = 1024 * 1024
+
     @FileParam(["left", "right"])
     def __init__(self, left, right):
         """ left points to the first file and right to the second file
@@ -153,21 +1435,34 @@ class Diff(object):
         if not self.right.exists():
             self.right = File("/dev/null")
 
+    def _get_labels(self, left_label, right_label):
+        if right_label and not left_label:
+            left_label = self.right.get_name()
+        return left_label, right_label
+
     def run(self, cwd, left_label=None, right_label=None, unified=True,
             fd=None):
+        """ Writes the differences of left and right to fd or stdout if fd is
+        None. Unified diffs of text files are created in-process, otherwise
+        the diff util is run.
+        """
+        if unified:
+            data = self.unified(cwd, left_label, right_label)
+            if data is not None:
+                _write_fd(fd, data)
+                return
+
         cmd = ["diff"]
 
         if unified:
             cmd.append("-u")
 
+        left_label, right_label = self._get_labels(left_label, right_label)
         if left_label:
             cmd.append("--label")
             cmd.append(left_label)
 
         if right_label:
-            if not left_label:
-                cmd.append("--label")
-                cmd.append(self.right.get_name())
             cmd.append("--label")
             cmd.append(right_label)
 
@@ -180,19 +1475,44 @@ class Diff(object):
             if e.get_returncode() > 1:
                 raise e
 
+    def unified(self, cwd, left_label=None, right_label=None):
+        """ Returns the unified diff of left and right as bytes like diff -u
+        does. Returns None for binary files, which are left to the diff util.
+        """
+        left_label, right_label = self._get_labels(left_label, right_label)
+        contents = []
+        headers = []
+        for file, label in ((self.left, left_label),
+                            (self.right, right_label)):
+            name = os.path.join(cwd, file.get_name())
+            with open(name, "rb") as f:
+                data = f.read()
+            if b"\0" in data:
+                return None
+            contents.append(data)
+            if label:
+                headers.append(_encode_str(label))
+            else:
+                headers.append(_encode_str(file.get_name()) + b"\t" +
+                               _format_mtime(os.stat(name)))
+        return unified_diff(contents[0], contents[1], headers[0], headers[1])
+
     def equal(self, cwd):
         """ Returns True if left and right are equal
         """
-        cmd = ["diff"]
-        cmd.append("-q")
-        cmd.append(self.left.get_name())
-        cmd.append(self.right.get_name())
-
-        try:
-            Process(cmd).run(cwd=cwd, suppress_output=True)
-        except SubprocessError as e:
-            if e.get_returncode() == 1:
-                return False
-            else:
-                raise e
-        return True
+        left = os.path.join(cwd, self.left.get_name())
+        right = os.path.join(cwd, self.right.get_name())
+        with open(left, "rb") as f1:
+            with open(right, "rb") as f2:
+                st1 = os.fstat(f1.fileno())
+                st2 = os.fstat(f2.fileno())
+                # the size of special files like /dev/null may be wrong
+                if stat.S_ISREG(st1.st_mode) and stat.S_ISREG(st2.st_mode) \
+                        and st1.st_size != st2.st_size:
+                    return False
+                while True:
+                    data = f1.read(self.chunk_size)
+                    if data != f2.read(self.chunk_size):
+                        return False
+                    if not data:
+                        return True
@@ -22,7 +22,7 @@ class Import(Command):
         self.quilt_pc = Directory(quilt_pc)
         self.quilt_patches = Directory(quilt_patches)
         self.db = Db(quilt_pc)
-        self.series = Series(quilt_patches)
+        self.series = Series(quilt_patches, self.quilt_pc + ".cache")
 
     def _import_patches(self, patches, reverse=False, strip=None):
         top = self.db.top_patch()
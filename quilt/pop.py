@@ -7,10 +7,14 @@
 # See LICENSE comming with the source of python-quilt for details.
 
 from errno import ENOENT
+from multiprocessing.pool import ThreadPool
+import multiprocessing
 import os.path, os
 
+from quilt.backup import MISSING, Manifest, ObjectStore, _file_signature, \
+                         hash_file
 from quilt.command import Command
-from quilt.db import Db
+from quilt.db import Db, FileIndex
 from quilt.error import NoAppliedPatch, QuiltError
 from quilt.patch import RollbackPatch, Patch
 from quilt.signals import Signal
@@ -32,7 +36,9 @@ class Pop(Command):
         super(Pop, self).__init__(cwd)
         self.quilt_pc = Directory(quilt_pc)
         self.db = Db(quilt_pc)
+        self.file_index = FileIndex(self.db)
         self._patches = patches_dir
+        self.store = ObjectStore(self.quilt_pc)
 
     def _check(self, force=False):
         if not self.db.exists() or not self.db.patches():
@@ -45,31 +51,73 @@ class Pop(Command):
                 raise QuiltError("Patch %s needs to be refreshed first." %
                                  patch.get_name())
 
-    def _check_timestamps(self, pc, patch):
+    def _check_timestamps(self, pc, patch, restored=None):
+        """ Raises _TimestampModified if the patch file or a file of the patch
+        has been modified after the patch has been applied.
+
+        restored may contain the backup files by file name which would be
+        restored by unapplying the patches above patch. They are checked
+        instead of the files in the working directory.
+
+        The files are looked up in the manifest of the patch if it is
+        current. Otherwise all backup files of the patch are checked. Files
+        which look modified according to their timestamp are hashed and
+        compared to the hash in the manifest.
+        """
         try:
             timestamp = os.stat(os.path.join(pc, ".timestamp")).st_mtime
             if self._patches is not None:
-                patch = os.stat(os.path.join(self._patches, patch))
-                if patch.st_mtime >= timestamp:
+                patch_stat = os.stat(os.path.join(self._patches, patch))
+                if patch_stat.st_mtime >= timestamp:
                     raise _TimestampModified("Patch file modified")
         except OSError as err:
             if err.errno != ENOENT:
                 raise
             raise _TimestampModified("Patch or original timestamp missing")
-        for [dirpath, dirnames, filenames] in os.walk(pc):
-            for file in filenames:
-                if file == ".timestamp":
+
+        manifest = Manifest(self.quilt_pc, patch)
+        if manifest.read() and manifest.is_current():
+            files = manifest.files.items()
+        else:
+            manifest.hashes = dict()
+            files = [(os.path.normpath(file), None) for file, is_dir in
+                     Directory(pc).walk() if not is_dir and
+                     file != ".timestamp"]
+
+        for file, signature in files:
+            path = os.path.join(self.cwd, file)
+            recorded = signature
+            if restored and file in restored:
+                path = restored[file]
+                # the state recorded in the manifest has been changed by the
+                # patches above
+                signature = None
+            try:
+                file_stat = os.stat(path)
+                if path != os.path.join(self.cwd, file) and \
+                        not file_stat.st_size:
+                    # the file would have been removed
+                    raise OSError(ENOENT, os.strerror(ENOENT), path)
+            except OSError as err:
+                if err.errno != ENOENT:
+                    raise
+                if recorded == MISSING:
+                    # removed by the patch. An empty backup of a patch above
+                    # means it has been created again by that patch.
                     continue
-                file = os.path.join(os.path.relpath(dirpath, pc), file)
-                try:
-                    file_stat = os.stat(os.path.join(self.cwd, file))
-                except OSError as err:
-                    if err.errno != ENOENT:
-                        raise
-                    raise _TimestampModified("File {} missing".format(file))
-                if file_stat.st_mtime >= timestamp:
-                    raise _TimestampModified("File {} modified".format(file))
-    
+                raise _TimestampModified("File {} missing".format(file))
+            if signature == _file_signature(file_stat):
+                continue
+            if file_stat.st_mtime < timestamp:
+                continue
+            digest = manifest.hashes.get(file)
+            if digest is not None:
+                with open(path, "rb") as f:
+                    if hash_file(f) == digest:
+                        # only touched
+                        continue
+            raise _TimestampModified("File {} modified".format(file))
+
     def _unapply_patch(self, patch, force):
         self.unapplying(patch)
 
@@ -91,26 +139,122 @@ class Pop(Command):
             self.empty_patch(patch)
         else:
             unpatch = RollbackPatch(self.cwd, pc_dir)
-            unpatch.rollback()
+            unpatch.rollback(move=True)
             unpatch.delete_backup()
+            self.store.release(pc_dir)
 
         self.db.remove_patch(patch)
+        self.file_index.remove_patch(patch_name)
 
         refresh = File(pc_dir.get_name() + "~refresh")
         refresh.delete_if_exists()
+        Manifest(self.quilt_pc, patch_name).delete()
 
         self.unapplied_patch(patch)
 
-    def unapply_patch(self, patch_name, force=False):
+    def _map(self, func, items, jobs):
+        """ Calls func for all items in jobs threads. By default the number
+        of CPUs is used. """
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        jobs = max(min(jobs, len(items)), 1)
+        if jobs == 1:
+            return [func(item) for item in items]
+        pool = ThreadPool(jobs)
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _backup_files(self, patch):
+        pc_dir = self.quilt_pc + patch.get_name()
+        return [os.path.normpath(file) for file, is_dir in pc_dir.walk()
+                if not is_dir and file != ".timestamp"]
+
+    def _check_patch(self, args):
+        """ Returns the error if the files of a patch have been modified """
+        patch, restored = args
+        pc_dir = self.quilt_pc + patch.get_name()
+        try:
+            self._check_timestamps(pc_dir.get_name(), patch.get_name(),
+                                   restored)
+        except _TimestampModified as err:
+            return err
+        return None
+
+    def _unapply_patches(self, patches, force, jobs=None):
+        """ Unapplies several patches at once. patches are ordered from the
+        top patch downwards.
+
+        Each file is restored only once from the backup of the lowest patch
+        it has been modified by. All patches are checked concurrently by jobs
+        threads before any file is restored.
+        """
+        # patch and backup to restore each file from; the last patch wins
+        restored = dict()
+        # backups of the patches above to check instead of the files
+        checked = []
+        for patch, files in zip(patches, self._map(self._backup_files,
+                                                   patches, jobs)):
+            pc_dir = self.quilt_pc + patch.get_name()
+            checked.append(dict([(file, restored[file][1]) for file in files
+                                 if file in restored]))
+            for file in files:
+                restored[file] = (patch.get_name(),
+                                  (pc_dir + File(file)).get_name())
+
+        errors = [None] * len(patches)
+        if not force:
+            errors = self._map(self._check_patch, list(zip(patches, checked)),
+                               jobs)
+        for err in errors:
+            if err is not None:
+                raise QuiltError(err)
+
+        # files to restore by the name of the patch with their backups
+        restored_by = dict()
+        for file, (patch_name, backup) in restored.items():
+            restored_by.setdefault(patch_name, []).append(file)
+
+        empty = set()
+        for patch in patches:
+            self.unapplying(patch)
+            pc_dir = self.quilt_pc + patch.get_name()
+            (pc_dir + File(".timestamp")).delete_if_exists()
+            if pc_dir.is_empty():
+                empty.add(patch)
+                continue
+            files = restored_by.get(patch.get_name())
+            if files:
+                RollbackPatch(self.cwd, pc_dir).rollback(move=True,
+                                                        files=files)
+
+        for patch in patches:
+            pc_dir = self.quilt_pc + patch.get_name()
+            if patch in empty:
+                pc_dir.delete()
+                self.empty_patch(patch)
+            else:
+                RollbackPatch(self.cwd, pc_dir).delete_backup()
+                self.store.release(pc_dir)
+            self.db.remove_patch(patch)
+            self.file_index.remove_patch(patch.get_name())
+            refresh = File(pc_dir.get_name() + "~refresh")
+            refresh.delete_if_exists()
+            Manifest(self.quilt_pc, patch.get_name()).delete()
+            self.unapplied_patch(patch)
+
+    def unapply_patch(self, patch_name, force=False, jobs=None):
         """ Unapply patches up to patch_name. patch_name will end up as top
-            patch """
+            patch. The patches are checked by jobs threads. """
         self._check(force)
 
         patches = self.db.patches_after(Patch(patch_name))
-        for patch in reversed(patches):
-            self._unapply_patch(patch, force=force)
+        self._unapply_patches(list(reversed(patches)), force=force, jobs=jobs)
 
         self.db.save()
+        self.file_index.save()
 
         self.unapplied(self.db.top_patch())
 
@@ -122,16 +266,18 @@ class Pop(Command):
         self._unapply_patch(patch, force=force)
 
         self.db.save()
+        self.file_index.save()
 
         self.unapplied(self.db.top_patch())
 
-    def unapply_all(self, force=False):
-        """ Unapply all patches """
+    def unapply_all(self, force=False, jobs=None):
+        """ Unapply all patches. The patches are checked by jobs threads. """
         self._check(force)
 
-        for patch in reversed(self.db.applied_patches()):
-            self._unapply_patch(patch, force=force)
+        self._unapply_patches(list(reversed(self.db.applied_patches())),
+                              force=force, jobs=jobs)
 
         self.db.save()
+        self.file_index.save()
 
         self.unapplied(self.db.top_patch())
@@ -6,14 +6,78 @@
 #
 # See LICENSE comming with the source of python-quilt for details.
 
+import multiprocessing
+import os
+import os.path
+import shutil
+import threading
+
+from six.moves import queue
+
+from quilt.backup import Manifest, ObjectStore
 from quilt.command import Command
-from quilt.db import Db, Series
+from quilt.db import Db, FileIndex, Series
 from quilt.error import NoPatchesInSeries, AllPatchesApplied, QuiltError
-from quilt.patch import Patch, RollbackPatch
+from quilt.patch import Patch, PatchApplier, PatchApplyError, PatchCache, \
+                        RollbackPatch, UnsupportedPatchFormat, HunkResult, \
+                        apply_hunks
 from quilt.signals import Signal
 from quilt.utils import SubprocessError, File, Directory
 
 
+def _readahead(path):
+    """ Asks the kernel to read the file path into the page cache in the
+    background. Does nothing if posix_fadvise isn't available.
+    """
+    fadvise = getattr(os, "posix_fadvise", None)
+    if fadvise is None:
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _check_file(cwd, name, changes):
+    """ Applies the changes of several patches to the file name in memory.
+    changes is a list of (patch index, FilePatch) tuples in series order.
+    Returns a list of (patch index, name, HunkResult) tuples of the failed
+    hunks. Later patches see the file with the applicable hunks of the
+    earlier patches applied.
+    """
+    path = os.path.join(cwd, name)
+    lines = []
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            lines = f.readlines()
+
+    failed = []
+    for index, file_patch in changes:
+        if file_patch.is_creation() and lines:
+            results = [HunkResult(number, hunk) for number, hunk in
+                       enumerate(file_patch.hunks, 1)]
+        else:
+            lines, results = apply_hunks(lines, file_patch.hunks)
+        failed.extend([(index, name, result) for result in results
+                       if result.failed()])
+    return failed
+
+
+def _check_files(args):
+    """ Runs _check_file for a shard of files in a worker process """
+    cwd, shard = args
+    failed = []
+    for name, changes in shard:
+        failed.extend(_check_file(cwd, name, changes))
+    return failed
+
+
 class Push(Command):
 
     applying = Signal()
@@ -21,13 +85,23 @@ class Push(Command):
     applied = Signal()
     applied_patch = Signal()
     applied_empty_patch = Signal()
+    check_failed = Signal()
 
     def __init__(self, cwd, quilt_pc, quilt_patches):
         super(Push, self).__init__(cwd)
         self.quilt_pc = Directory(quilt_pc)
         self.quilt_patches = Directory(quilt_patches)
         self.db = Db(quilt_pc)
-        self.series = Series(quilt_patches)
+        self.file_index = FileIndex(self.db)
+        self.series = Series(quilt_patches, self.quilt_pc + ".cache")
+        self.patch_cache = PatchCache(self.quilt_pc + ".cache")
+        self.store = ObjectStore(self.quilt_pc)
+
+    def _get_store(self):
+        """ Returns the ObjectStore for backups or None if it isn't used """
+        if self.store.exists():
+            return self.store
+        return None
 
     def _apply_patch(self, patch, force=False, quiet=False):
         patch_name = patch.get_name()
@@ -43,27 +117,37 @@ class Push(Command):
 
         if patch_file.exists():
             try:
-                patch.run(self.cwd, patch_dir=self.quilt_patches, backup=True,
-                          prefix=pc_dir.get_name(), quiet=quiet)
+                patch.apply(self.cwd, patch_dir=self.quilt_patches,
+                            backup=True, prefix=pc_dir.get_name(), quiet=quiet,
+                            cache=self.patch_cache, store=self._get_store())
                 refresh.delete_if_exists()
-            except SubprocessError as e:
+            except (PatchApplyError, SubprocessError):
                 refresh.touch()
 
                 if not force:
-                    patch = RollbackPatch(self.cwd, pc_dir)
-                    patch.rollback()
-                    patch.delete_backup()
+                    if pc_dir.exists():
+                        # e.g. no backups if the patch contains no diff
+                        patch = RollbackPatch(self.cwd, pc_dir)
+                        patch.rollback(move=True)
+                        patch.delete_backup()
+                    self.store.release(pc_dir)
+                    Manifest(self.quilt_pc, patch_name).delete()
                     raise QuiltError("Patch %s does not apply" % patch_name)
                 else:
                     forced = True
+            self.store.record(pc_dir)
 
         self.db.add_patch(patch)
 
         if pc_dir.exists():
             timestamp = pc_dir + File(".timestamp")
             timestamp.touch()
+            names = self._backup_names(patch_name)
+            self._record_manifest(patch_name, names)
+            self.file_index.add_patch(patch_name, names)
         else:
             pc_dir.create()
+            self.file_index.add_patch(patch_name, [])
 
         if not patch_file.exists():
             self.applied_empty_patch(patch, False)
@@ -75,6 +159,211 @@ class Push(Command):
         else:
             self.applied_patch(patch)
 
+    def _prefetch_patch(self, patch):
+        """ Parses the patch file of patch into the patch cache and reads
+        ahead the files it changes. Errors are ignored; they show up again
+        when the patch is applied.
+        """
+        path = os.path.join(self.cwd, (self.quilt_patches +
+                                       File(patch.get_name())).get_name())
+        try:
+            if os.path.getsize(path) > self.patch_cache.max_size:
+                _readahead(path)
+                return
+            file_patches = self.patch_cache.prefetch(path) or []
+            strip = patch.get_strip()
+            for file_patch in file_patches:
+                name = file_patch.get_target(strip, lambda name:
+                                             os.path.exists(os.path.join(
+                                                 self.cwd, name)))
+                if name:
+                    _readahead(os.path.join(self.cwd, name))
+        except Exception:
+            pass
+
+    def _prefetch(self, patches, depth):
+        """ Generator of patches. A background thread prefetches the patches
+        via _prefetch_patch while the previous ones are applied. It runs at
+        most depth patches ahead.
+        """
+        prefetched = queue.Queue(depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    prefetched.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def run():
+            try:
+                for patch in patches:
+                    self._prefetch_patch(patch)
+                    if not put(patch):
+                        return
+            finally:
+                put(None)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                patch = prefetched.get()
+                if patch is None:
+                    break
+                yield patch
+        finally:
+            stop.set()
+            thread.join()
+
+    def _apply_patches_batch(self, patches, force=False, quiet=False):
+        """ Applies patches in memory and writes each modified file only once
+        after all patches have been applied. Only the backups are written for
+        each patch.
+
+        If a patch can't be applied in memory all changes made so far are
+        written and the patch is applied via _apply_patch to get the same
+        behaviour as in non-batch mode.
+        """
+        # current contents of all files touched so far; None if removed
+        files = dict()
+        changed = set()
+        # patches with backups
+        patch_names = []
+        # manifests of the patches recorded from the patched contents
+        manifests = dict()
+
+        def flush():
+            writer = PatchApplier(self.cwd)
+            newest = 0
+            for name in changed:
+                if files[name] is None:
+                    writer.remove(name)
+                else:
+                    writer.write(name, files[name])
+                    newest = max(newest, os.stat(os.path.join(
+                        self.cwd, name)).st_mtime)
+            changed.clear()
+            files.clear()
+            # files must be older than the timestamps of the patches. Written
+            # files and timestamps may get the same mtime on file systems with
+            # coarse timestamps.
+            for patch_name in patch_names:
+                timestamp = self.quilt_pc + File(os.path.join(patch_name,
+                                                              ".timestamp"))
+                timestamp.touch()
+                st = os.stat(timestamp.get_name())
+                if st.st_mtime <= newest:
+                    os.utime(timestamp.get_name(), (st.st_atime,
+                                                    newest + 0.01))
+                manifest = manifests.pop(patch_name)
+                manifest.record_timestamp()
+                manifest.save()
+            del patch_names[:]
+
+        try:
+            for patch in patches:
+                self.applying(patch)
+
+                patch_name = patch.get_name()
+                pc_dir = self.quilt_pc + patch_name
+                patch_file = self.quilt_patches + File(patch_name)
+                refresh = File(pc_dir.get_name() + "~refresh")
+
+                if refresh.exists():
+                    raise QuiltError("Patch %s needs to be refreshed" %
+                                     patch_name)
+
+                applier = None
+                if patch_file.exists():
+                    applier = self._apply_patch_in_memory(patch, files, quiet)
+                    if applier is None or applier.failed:
+                        # apply the patch on disk as usual
+                        flush()
+                        self._apply_patch(patch, force, quiet)
+                        continue
+
+                self.applying_patch(patch)
+                manifest = Manifest(self.quilt_pc, patch_name)
+                if applier:
+                    applier.flush_messages()
+                    for name, lines in applier.contents.items():
+                        self._write_backup(pc_dir, name,
+                                           applier.originals[name])
+                        files[name] = lines
+                        changed.add(name)
+                        if lines is not None:
+                            lines = b"".join(lines)
+                        manifest.record_data(name, lines)
+                    self.store.record(pc_dir)
+
+                self.db.add_patch(patch)
+                self.file_index.add_patch(patch_name, applier and
+                                          list(applier.contents) or [])
+                pc_dir.create()
+                if not pc_dir.is_empty():
+                    patch_names.append(patch_name)
+                    manifests[patch_name] = manifest
+
+                if not patch_file.exists():
+                    self.applied_empty_patch(patch, False)
+                elif pc_dir.is_empty():
+                    self.applied_empty_patch(patch, True)
+                else:
+                    self.applied_patch(patch)
+        finally:
+            flush()
+
+    def _apply_patch_in_memory(self, patch, files, quiet):
+        """ Returns a PatchApplier containing the results of applying patch
+        to files or None if the patch can't be applied in memory """
+        applier = PatchApplier(self.cwd, quiet=quiet, files=files,
+                               no_backup_if_mismatch=True, buffered=True)
+        try:
+            for file_patch, hunks in patch.read_file_patches(
+                    self.cwd, self.quilt_patches, self.patch_cache,
+                    patch.reverse):
+                applier.apply(file_patch, patch.get_strip(), hunks)
+        except UnsupportedPatchFormat:
+            return None
+        return applier
+
+    def _backup_names(self, patch_name):
+        """ Returns the names of the backup files of patch_name """
+        pc_dir = self.quilt_pc + patch_name
+        return [name for name, is_dir in pc_dir.walk()
+                if not is_dir and name != ".timestamp"]
+
+    def _record_manifest(self, patch_name, names):
+        """ Records the state of the files names of the applied patch
+        patch_name for Pop """
+        manifest = Manifest(self.quilt_pc, patch_name)
+        manifest.record(self.cwd, names)
+        manifest.save()
+
+    def _write_backup(self, pc_dir, name, lines):
+        """ Writes lines as backup of file name into pc_dir. An empty backup
+        is created if lines is None. """
+        backup = pc_dir + File(name)
+        path = os.path.join(self.cwd, name)
+        store = self._get_store()
+        if store and lines is not None and os.path.exists(path):
+            store.add_data(b"".join(lines), os.stat(path).st_mode,
+                           backup.get_name())
+            return
+        backup.get_directory().create()
+        if backup.exists() and os.stat(backup.get_name()).st_nlink > 1:
+            # don't modify other hard links like objects of the store
+            backup.delete()
+        with open(backup.get_name(), "wb") as f:
+            f.writelines(lines or [])
+        if lines is not None and os.path.exists(path):
+            shutil.copymode(path, backup.get_name())
+
     def _check(self):
         if not self.series.exists() or not self.series.patches():
             raise NoPatchesInSeries(self.series)
@@ -83,12 +372,9 @@ class Push(Command):
         """ Apply all patches up to patch_name """
         self._check()
         patch = Patch(patch_name)
-        patches = self.series.patches_until(patch)[:]
-
-        applied = self.db.applied_patches()
-        for patch in applied:
-            if patch in patches:
-                patches.remove(applied)
+        patches = [cur_patch for cur_patch in
+                   self.series.patches_until(patch)
+                   if not self.db.is_patch(cur_patch)]
 
         if not patches:
             raise AllPatchesApplied(self.series, self.db.top_patch())
@@ -99,6 +385,7 @@ class Push(Command):
             self._apply_patch(cur_patch, force, quiet)
 
         self.db.save()
+        self.file_index.save()
 
         self.applied(self.db.top_patch())
 
@@ -119,11 +406,118 @@ class Push(Command):
         self._apply_patch(patch, force, quiet)
 
         self.db.save()
+        self.file_index.save()
 
         self.applied(self.db.top_patch())
 
-    def apply_all(self, force=False, quiet=False):
-        """ Apply all patches in series file """
+    def _get_file_changes(self, patches):
+        """ Parses patches and groups their changes by the file they modify.
+        Returns a dict of file name to lists of (patch index, FilePatch)
+        tuples and a dict of patch index to error messages for patches that
+        can't be checked.
+        """
+        changes = dict()
+        errors = dict()
+        # files created or removed by the patches
+        exists = dict()
+
+        def file_exists(name):
+            if name in exists:
+                return exists[name]
+            return os.path.exists(os.path.join(self.cwd, name))
+
+        for index, patch in enumerate(patches):
+            patch_file = self.quilt_patches + File(patch.get_name())
+            if not patch_file.exists():
+                continue
+            try:
+                file_patches = patch.get_file_patches(self.cwd,
+                                                      self.quilt_patches,
+                                                      self.patch_cache)
+            except UnsupportedPatchFormat as e:
+                errors[index] = str(e)
+                continue
+            for file_patch in file_patches:
+                if patch.reverse:
+                    file_patch = file_patch.reverse()
+                if not file_patch.hunks:
+                    continue
+                name = file_patch.get_target(patch.get_strip(), file_exists)
+                if name is None:
+                    errors[index] = "can't find file to patch"
+                    continue
+                if file_patch.is_creation():
+                    exists[name] = True
+                elif file_patch.is_deletion():
+                    exists[name] = False
+                changes.setdefault(name, []).append((index, file_patch))
+        return changes, errors
+
+    def check_all(self, jobs=None):
+        """ Checks if all unapplied patches in the series file can be applied
+        without changing any file. Each patch is checked against the contents
+        the files would have after applying the previous patches.
+
+        The files are checked concurrently by jobs processes. By default the
+        number of CPUs is used. For each patch that doesn't apply the
+        check_failed signal is emitted with the patch, a list of
+        (filename, HunkResult) tuples of the failed hunks and an error message
+        or None. Returns the list of patches that don't apply.
+        """
+        self._check()
+        top = self.db.top_patch()
+        if top:
+            patches = self.series.patches_after(top)
+        else:
+            patches = self.series.patches()
+
+        if not patches:
+            raise AllPatchesApplied(self.series, top)
+
+        changes, errors = self._get_file_changes(patches)
+
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        jobs = max(min(jobs, len(changes)), 1)
+        # several shards per job to balance files of different sizes
+        shards = [[] for i in range(jobs * 4)]
+        for i, name in enumerate(sorted(changes)):
+            shards[i % len(shards)].append((name, changes[name]))
+        shards = [(self.cwd, shard) for shard in shards if shard]
+
+        if jobs == 1:
+            results = map(_check_files, shards)
+        else:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                results = pool.map(_check_files, shards)
+            finally:
+                pool.close()
+                pool.join()
+
+        failed = dict()
+        for result in results:
+            for index, name, hunk_result in result:
+                failed.setdefault(index, []).append((name, hunk_result))
+
+        failed_patches = []
+        for index, patch in enumerate(patches):
+            if index not in failed and index not in errors:
+                continue
+            hunks = sorted(failed.get(index, []),
+                           key=lambda item: (item[0], item[1].number))
+            self.check_failed(patch, hunks, errors.get(index))
+            failed_patches.append(patch)
+        return failed_patches
+
+    def apply_all(self, force=False, quiet=False, batch=False, prefetch=0):
+        """ Apply all patches in series file
+
+        If batch is True the patches are applied in memory and each modified
+        file is written only once. If prefetch is greater than 0 up to that
+        many of the following patch files are read and parsed in a
+        background thread while a patch is applied.
+        """
         self._check()
         top = self.db.top_patch()
         if top:
@@ -134,10 +528,22 @@ class Push(Command):
         if not patches:
             raise AllPatchesApplied(self.series, top)
 
-        for patch in patches:
-            self.applying(patch)
-            self._apply_patch(patch, force, quiet)
+        if prefetch > 0:
+            patches = self._prefetch(patches, prefetch)
+
+        try:
+            if batch:
+                self._apply_patches_batch(patches, force, quiet)
+            else:
+                for patch in patches:
+                    self.applying(patch)
+                    self._apply_patch(patch, force, quiet)
+        finally:
+            if prefetch > 0:
+                # stops the prefetching thread
+                patches.close()
 
         self.db.save()
+        self.file_index.save()
 
         self.applied(self.db.top_patch())
@@ -6,12 +6,16 @@
 #
 # See LICENSE comming with the source of python-quilt for details.
 
+import io
+import multiprocessing
 import os.path
+import tempfile
 
+from quilt.backup import Manifest
 from quilt.command import Command
 from quilt.db import Db, Series
 from quilt.error import QuiltError
-from quilt.patch import Patch, Diff
+from quilt.patch import Patch, PatchCache, Diff, DiffCache
 from quilt.signals import Signal
 from quilt.utils import Directory, File, TmpFile, _encode_str
 
@@ -19,6 +23,14 @@ INDEX_LINE = \
     b"==================================================================="
 
 
+def _diff_file(args):
+    """ Returns the unified diff of a file as bytes or None if the diff util
+    has to be run. Called in the worker processes of Refresh.
+    """
+    cwd, orig_file, new_file, left_label, right_label = args
+    return Diff(orig_file, new_file).unified(cwd, left_label, right_label)
+
+
 class Refresh(Command):
     """ Command class to refresh (add or remove chunks) a patch
     """
@@ -31,11 +43,15 @@ class Refresh(Command):
         self.quilt_pc = Directory(quilt_pc)
         self.quilt_patches = Directory(quilt_patches)
         self.db = Db(quilt_pc)
-        self.series = Series(quilt_patches)
+        self.series = Series(quilt_patches, self.quilt_pc + ".cache")
+        self.patch_cache = PatchCache(self.quilt_pc + ".cache")
 
-    def refresh(self, patch_name=None, edit=False):
+    def refresh(self, patch_name=None, edit=False, jobs=1):
         """ Refresh patch with patch_name or applied top patch if patch_name is
         None
+
+        The files of the patch are compared by jobs processes concurrently. If
+        jobs is None the number of CPUs is used.
         """
         if patch_name:
             patch = Patch(patch_name)
@@ -47,52 +63,118 @@ class Refresh(Command):
 
         pc_dir = self.quilt_pc + patch.get_name()
         patch_file = self.quilt_patches + File(patch.get_name())
-        files = pc_dir.content()[1]
-
-        with TmpFile(prefix="pquilt-") as tmpfile:
-            f = tmpfile.open()
-
-            if patch_file.exists():
-                header = patch.get_header(self.quilt_patches)
-                tmpfile.write(header)
-
-            for file_name in files:
-                if file_name == ".timestamp":
-                    continue
-                orig_file = pc_dir + File(file_name)
-                new_file = File(file_name)
-                left_label, right_label, index = self._get_labels(file_name,
-                                                                  orig_file,
-                                                                  new_file)
-                self._write_index(tmpfile, index)
-
-                diff = Diff(orig_file, new_file)
-                diff.run(self.cwd, fd=f, left_label=left_label,
-                         right_label=right_label)
-
-            if tmpfile.is_empty():
-                raise QuiltError("Nothing to refresh.")
-
-            if edit:
+        files = (name for name, is_dir in pc_dir.walk() if not is_dir)
+
+        # the new patch is created in memory
+        out = io.BytesIO()
+
+        if patch_file.exists():
+            header = patch.get_header(self.quilt_patches,
+                                      cache=self.patch_cache)
+            out.write(header)
+
+        diff_cache = DiffCache(self.quilt_pc + ".cache", patch.get_name())
+        tasks = []
+        for file_name in files:
+            if file_name == ".timestamp":
+                continue
+            orig_file = pc_dir + File(file_name)
+            new_file = File(file_name)
+            left_label, right_label, index = self._get_labels(file_name,
+                                                              orig_file,
+                                                              new_file)
+            signature = diff_cache.get_signature(
+                os.path.join(self.cwd, orig_file.get_name()),
+                os.path.join(self.cwd, new_file.get_name()))
+            if signature is not None:
+                signature += (left_label, right_label)
+            tasks.append((index, file_name, signature,
+                          (self.cwd, orig_file, new_file, left_label,
+                           right_label)))
+
+        # only compare the files modified since the last refresh
+        diffs = [diff_cache.get(file_name, signature) for
+                 index, file_name, signature, args in tasks]
+        missing = [i for i, data in enumerate(diffs) if data is None]
+        results = self._diff_files([tasks[i][3] for i in missing], jobs)
+        for i, data in zip(missing, results):
+            diffs[i] = data
+
+        for (index, file_name, signature, args), data in zip(tasks, diffs):
+            self._write_index(out, index)
+            if data is None:
+                out.write(self._run_diff(*args))
+            else:
+                diff_cache.set(file_name, signature, data)
+                out.write(data)
+        diff_cache.save()
+        diff_cache.prune([p.get_name() for p in self.series.patches()])
+
+        content = out.getvalue()
+        if not content:
+            raise QuiltError("Nothing to refresh.")
+
+        if edit:
+            with TmpFile(prefix="pquilt-") as tmpfile:
+                tmpfile.write(content)
                 self.edit_patch(tmpfile)
                 tpatch = Patch(tmpfile.get_name())
                 tpatch.run(pc_dir.get_name(), dry_run=True, quiet=True)
-
-            timestamp = pc_dir + File(".timestamp")
-            if patch_file.exists():
-                diff = Diff(patch_file, tmpfile)
-                if diff.equal(self.cwd):
+                with open(tmpfile.get_name(), "rb") as f:
+                    content = f.read()
+
+        timestamp = pc_dir + File(".timestamp")
+        if patch_file.exists():
+            with open(patch_file.get_name(), "rb") as f:
+                if os.fstat(f.fileno()).st_size == len(content) and \
+                        f.read() == content:
                     timestamp.touch()
+                    self._record_manifest(patch, tasks)
                     raise QuiltError("Nothing to refresh.")
 
-            tmpfile.copy(patch_file)
+        with open(patch_file.get_name(), "wb") as f:
+            f.write(content)
         timestamp.touch()
+        self._record_manifest(patch, tasks)
 
         refresh = self.quilt_pc + File(patch.get_name() + "~refresh")
         refresh.delete_if_exists()
 
         self.refreshed(patch)
 
+    def _record_manifest(self, patch, tasks):
+        """ The files of the patch are up to date after refreshing it """
+        manifest = Manifest(self.quilt_pc, patch.get_name())
+        manifest.record(self.cwd, [task[1] for task in tasks])
+        manifest.save()
+
+    def _diff_files(self, tasks, jobs):
+        """ Returns the results of _diff_file for tasks in the same order """
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        jobs = max(min(jobs, len(tasks)), 1)
+        if jobs == 1:
+            return [_diff_file(args) for args in tasks]
+
+        pool = multiprocessing.Pool(jobs)
+        try:
+            # several chunks per job to balance files of different sizes
+            return pool.map(_diff_file, tasks,
+                            max(len(tasks) // (jobs * 4), 1))
+        finally:
+            pool.close()
+            pool.join()
+
+    def _run_diff(self, cwd, orig_file, new_file, left_label, right_label):
+        """ Returns the output of the diff util for files which can't be
+        compared in-process """
+        with tempfile.TemporaryFile() as f:
+            diff = Diff(orig_file, new_file)
+            diff.run(cwd, fd=f, left_label=left_label,
+                     right_label=right_label)
+            f.seek(0)
+            return f.read()
+
     def _get_labels(self, file_name, old_file, new_file):
         dir = os.path.basename(self.cwd)
 
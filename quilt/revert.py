@@ -8,9 +8,9 @@
 
 import os
 
-from quilt.backup import Backup
+from quilt.backup import Backup, Manifest
 from quilt.command import Command
-from quilt.db import Db, Series
+from quilt.db import Db, FileIndex, Series
 from quilt.error import QuiltError
 from quilt.patch import Diff, Patch
 from quilt.signals import Signal
@@ -30,7 +30,12 @@ class Revert(Command):
         self.quilt_pc = Directory(quilt_pc)
         self.quilt_patches = Directory(quilt_patches)
         self.db = Db(quilt_pc)
-        self.series = Series(quilt_patches)
+        self.file_index = FileIndex(self.db)
+        self.series = Series(quilt_patches, self.quilt_pc + ".cache")
+        # manifests by patch name and whether the file index has been
+        # changed since the last call of _save
+        self._manifests = dict()
+        self._index_changed = False
 
     def _file_in_patch(self, filename, patch):
         """ Checks if a backup file of the filename in the current patch
@@ -50,13 +55,13 @@ class Revert(Command):
             # no paches applied
             return
 
-        patches = self.db.patches_after(patch)
-        for patch in patches:
-            file = self.quilt_pc + File(os.path.join(patch.get_name(),
-                                                     filename))
-            if file.exists():
-                raise QuiltError("File %s is modified by patch %s" %
-                                 (filename, patch.get_name()))
+        if not self.file_index.valid:
+            self.file_index.build()
+            self.file_index.save()
+        patches = self.file_index.patches_after(filename, patch.get_name())
+        if patches:
+            raise QuiltError("File %s is modified by patch %s" %
+                             (filename, patches[0]))
 
     def _apply_patch_temporary(self, tmpdir, file, patch):
         backup = Backup()
@@ -69,10 +74,26 @@ class Revert(Command):
                       remove_empty_files=True, force=True, quiet=True)
         return backup_file
 
-    def revert_file(self, filename, patch_name=None):
-        """ Revert not added changes of filename.
-        If patch_name is None or empty the topmost patch will be used.
-        """
+    def _get_manifest(self, patch):
+        """ Returns the Manifest of patch or None if it doesn't exist """
+        name = patch.get_name()
+        if name not in self._manifests:
+            manifest = Manifest(self.quilt_pc, name)
+            self._manifests[name] = manifest.read() and manifest or None
+        return self._manifests[name]
+
+    def _save(self):
+        """ Writes the manifests and the file index changed by the reverted
+        files """
+        for manifest in self._manifests.values():
+            if manifest:
+                manifest.save()
+        self._manifests.clear()
+        if self._index_changed:
+            self.file_index.save()
+            self._index_changed = False
+
+    def _revert_file(self, filename, patch_name):
         file = File(filename)
 
         if patch_name:
@@ -91,6 +112,11 @@ class Revert(Command):
         if not file.exists() and pc_file.is_empty():
             # new and empty file will be reverted
             pc_file.delete()
+            manifest = self._get_manifest(patch)
+            if manifest:
+                manifest.remove(filename)
+            self.file_index.remove_file(patch.get_name(), filename)
+            self._index_changed = True
             self.file_reverted(file, patch)
             return
 
@@ -111,10 +137,27 @@ class Revert(Command):
                 else:
                     dir.create()
                 tmp_file.copy(dir)
+                manifest = self._get_manifest(patch)
+                if manifest:
+                    manifest.record(self.cwd, [filename])
                 self.file_reverted(file, patch)
             else:
                 self.file_unchanged(file, patch)
 
+    def revert_file(self, filename, patch_name=None):
+        """ Revert not added changes of filename.
+        If patch_name is None or empty the topmost patch will be used.
+        """
+        try:
+            self._revert_file(filename, patch_name)
+        finally:
+            self._save()
+
     def revert_files(self, filenames, patch_name=None):
-        for filename in filenames:
-            self.revert_file(filename, patch_name)
+        """ Reverts several files like revert_file. The manifest of the
+        patch and the file index are written only once. """
+        try:
+            for filename in filenames:
+                self._revert_file(filename, patch_name)
+        finally:
+            self._save()
@@ -0,0 +1,584 @@
+# vim: fileencoding=utf-8 et sw=4 ts=4 tw=80:
+
+# python-quilt - A Python implementation of the quilt patch system
+#
+# Copyright (C) 2012 - 2017 Björn Ricks <bjoern.ricks@gmail.com>
+#
+# See LICENSE comming with the source of python-quilt for details.
+
+""" Creates unified diffs in-process.
+
+The output is the same as the one of GNU diff -u. Therefore the algorithm of
+GNU diff is used: identical prefix and suffix are skipped, lines without a
+match in the other file are discarded, the remaining lines are compared with
+Myers' algorithm and finally the changes are shifted to the positions GNU diff
+would choose.
+"""
+
+NEWLINE = b"\n"[0]
+
+NO_NEWLINE_MARKER = b"\\ No newline at end of file\n"
+
+# number of context lines of diff -u
+CONTEXT = 3
+
+# compare big chunks first when looking for the identical prefix
+_CHUNK_SIZE = 64 * 1024
+
+
+def split_lines(data):
+    """ Splits bytes into lines including the newline characters. Only \\n is
+    treated as line separator. """
+    lines = data.split(b"\n")
+    last = lines.pop()
+    lines = [line + b"\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def _common_prefix(a, b):
+    """ Returns the length of the common prefix of the bytes a and b """
+    n = min(len(a), len(b))
+    pos = 0
+    while pos < n:
+        end = min(pos + _CHUNK_SIZE, n)
+        if a[pos:end] == b[pos:end]:
+            pos = end
+            continue
+        while a[pos:pos + 1] == b[pos:pos + 1]:
+            pos += 1
+        break
+    return pos
+
+
+def _find_identical_ends(a, b, horizon):
+    """ Returns the offsets of the end of the identical prefix and the
+    beginnings of the identical suffixes of the bytes a and b. horizon lines
+    of the prefix and suffix are kept to be compared. """
+    n0 = len(a)
+    n1 = len(b)
+    missing0 = n0 > 0 and a[-1] != NEWLINE
+    missing1 = n1 > 0 and b[-1] != NEWLINE
+
+    p = _common_prefix(a, b)
+    # don't count a missing newline as part of the prefix
+    if (n0 - missing0 < p) != (n1 - missing1 < p):
+        p -= 1
+    # go back to the start of the line and keep horizon lines
+    i = horizon
+    while p:
+        if a[p - 1] == NEWLINE:
+            if not i:
+                break
+            i -= 1
+        p -= 1
+    prefix_end = p
+
+    s0 = n0
+    s1 = n1
+    if missing0 == missing1:
+        beg0 = prefix_end + (0 if n0 < n1 else n0 - n1)
+        while s0 != beg0:
+            s0 -= 1
+            s1 -= 1
+            if a[s0] != b[s1]:
+                s0 += 1
+                s1 += 1
+                beg0 = s0
+                break
+        # skip horizon lines of the suffix and the rest of an incomplete line
+        i = horizon + (not ((s0 == 0 or a[s0 - 1] == NEWLINE) and
+                            (s1 == 0 or b[s1 - 1] == NEWLINE)))
+        while i and s0 != n0:
+            i -= 1
+            end = a.find(b"\n", s0)
+            s0 = n0 if end < 0 else end + 1
+        s1 += s0 - beg0
+    return prefix_end, s0, s1
+
+
+def _discard_confusing_lines(equivs, counts):
+    """ Returns a list of discard flags for each line in equivs of a file.
+    counts is a list containing the number of lines of each equivalence class
+    in the other file. 1 means the line has no match in the other file and is
+    discarded. The flags of lines with lots of matches are computed like GNU
+    diff does. """
+    end = len(equivs)
+    many = 5
+    tem = end // 64
+    tem >>= 2
+    while tem > 0:
+        many *= 2
+        tem >>= 2
+
+    discards = [0] * end
+    for i, equiv in enumerate(equivs):
+        nmatch = counts[equiv]
+        if nmatch == 0:
+            discards[i] = 1
+        elif nmatch > many:
+            discards[i] = 2
+
+    # don't really discard the provisional lines except when they occur in a
+    # run of discardables, with nonprovisionals at the beginning and end
+    i = 0
+    while i < end:
+        if discards[i] == 2:
+            discards[i] = 0
+        elif discards[i] != 0:
+            provisional = 0
+            j = i
+            while j < end:
+                if discards[j] == 0:
+                    break
+                if discards[j] == 2:
+                    provisional += 1
+                j += 1
+            while j > i and discards[j - 1] == 2:
+                j -= 1
+                discards[j] = 0
+                provisional -= 1
+            length = j - i
+
+            if provisional * 4 > length:
+                while j > i:
+                    j -= 1
+                    if discards[j] == 2:
+                        discards[j] = 0
+            else:
+                minimum = 1
+                tem = length >> 2
+                tem >>= 2
+                while tem > 0:
+                    minimum <<= 1
+                    tem >>= 2
+                minimum += 1
+
+                # cancel any subrun of minimum or more provisionals
+                j = 0
+                consec = 0
+                while j < length:
+                    if discards[i + j] != 2:
+                        consec = 0
+                    else:
+                        consec += 1
+                        if minimum == consec:
+                            # back up to the start of the subrun
+                            j -= consec
+                        elif minimum < consec:
+                            discards[i + j] = 0
+                    j += 1
+
+                # cancel provisionals at the start of the run until 3
+                # nonprovisionals in a row or one at least 8 lines in
+                j = 0
+                consec = 0
+                while j < length:
+                    if j >= 8 and discards[i + j] == 1:
+                        break
+                    if discards[i + j] == 2:
+                        consec = 0
+                        discards[i + j] = 0
+                    elif discards[i + j] == 0:
+                        consec = 0
+                    else:
+                        consec += 1
+                    if consec == 3:
+                        break
+                    j += 1
+
+                i += length - 1
+
+                # same from the end of the run
+                j = 0
+                consec = 0
+                while j < length:
+                    if j >= 8 and discards[i - j] == 1:
+                        break
+                    if discards[i - j] == 2:
+                        consec = 0
+                        discards[i - j] = 0
+                    elif discards[i - j] == 0:
+                        consec = 0
+                    else:
+                        consec += 1
+                    if consec == 3:
+                        break
+                    j += 1
+        i += 1
+    return discards
+
+
+class _Compare(object):
+
+    """ Myers' O(ND) algorithm with the divide and conquer strategy and the
+    cost limit of GNU diff """
+
+    def __init__(self, xv, yv, xchanged, ychanged):
+        self.xv = xv
+        self.yv = yv
+        # flags of the changed lines, indexed by the position in xv and yv
+        self.xchanged = xchanged
+        self.ychanged = ychanged
+
+        diags = len(xv) + len(yv) + 3
+        self.offset = len(yv) + 1
+        self.fd = [0] * diags
+        self.bd = [0] * diags
+
+        too_expensive = 1
+        while diags:
+            too_expensive <<= 1
+            diags >>= 2
+        self.too_expensive = max(4096, too_expensive)
+
+    def _diag(self, xoff, xlim, yoff, ylim, find_minimal):
+        """ Returns (xmid, ymid, lo_minimal, hi_minimal) of a point where the
+        shortest edit script splits """
+        fd = self.fd
+        bd = self.bd
+        xv = self.xv
+        yv = self.yv
+        o = self.offset
+        dmin = xoff - ylim
+        dmax = xlim - yoff
+        fmid = xoff - yoff
+        bmid = xlim - ylim
+        fmin = fmax = fmid
+        bmin = bmax = bmid
+        odd = (fmid - bmid) & 1
+
+        fd[o + fmid] = xoff
+        bd[o + bmid] = xlim
+
+        c = 0
+        while True:
+            c += 1
+
+            if fmin > dmin:
+                fmin -= 1
+                fd[o + fmin - 1] = -1
+            else:
+                fmin += 1
+            if fmax < dmax:
+                fmax += 1
+                fd[o + fmax + 1] = -1
+            else:
+                fmax -= 1
+            for d in range(fmax, fmin - 1, -2):
+                tlo = fd[o + d - 1]
+                thi = fd[o + d + 1]
+                x = thi if tlo < thi else tlo + 1
+                y = x - d
+                while x < xlim and y < ylim and xv[x] == yv[y]:
+                    x += 1
+                    y += 1
+                fd[o + d] = x
+                if odd and bmin <= d <= bmax and bd[o + d] <= x:
+                    return x, y, True, True
+
+            if bmin > dmin:
+                bmin -= 1
+                bd[o + bmin - 1] = xlim + ylim + 1
+            else:
+                bmin += 1
+            if bmax < dmax:
+                bmax += 1
+                bd[o + bmax + 1] = xlim + ylim + 1
+            else:
+                bmax -= 1
+            for d in range(bmax, bmin - 1, -2):
+                tlo = bd[o + d - 1]
+                thi = bd[o + d + 1]
+                x = tlo if tlo < thi else thi - 1
+                y = x - d
+                while xoff < x and yoff < y and xv[x - 1] == yv[y - 1]:
+                    x -= 1
+                    y -= 1
+                bd[o + d] = x
+                if not odd and fmin <= d <= fmax and x <= fd[o + d]:
+                    return x, y, True, True
+
+            if find_minimal or c < self.too_expensive:
+                continue
+
+            # give up and report halfway between the best results so far
+            fxybest = -1
+            fxbest = 0
+            for d in range(fmax, fmin - 1, -2):
+                x = min(fd[o + d], xlim)
+                y = x - d
+                if ylim < y:
+                    x = ylim + d
+                    y = ylim
+                if fxybest < x + y:
+                    fxybest = x + y
+                    fxbest = x
+
+            bxybest = None
+            bxbest = 0
+            for d in range(bmax, bmin - 1, -2):
+                x = max(xoff, bd[o + d])
+                y = x - d
+                if y < yoff:
+                    x = yoff + d
+                    y = yoff
+                if bxybest is None or x + y < bxybest:
+                    bxybest = x + y
+                    bxbest = x
+
+            if (xlim + ylim) - bxybest < fxybest - (xoff + yoff):
+                return fxbest, fxybest - fxbest, True, False
+            return bxbest, bxybest - bxbest, False, True
+
+    def compare(self):
+        """ Marks the changed lines """
+        xv = self.xv
+        yv = self.yv
+        stack = [(0, len(xv), 0, len(yv), False)]
+        while stack:
+            xoff, xlim, yoff, ylim, find_minimal = stack.pop()
+
+            while xoff < xlim and yoff < ylim and xv[xoff] == yv[yoff]:
+                xoff += 1
+                yoff += 1
+            while xoff < xlim and yoff < ylim and \
+                    xv[xlim - 1] == yv[ylim - 1]:
+                xlim -= 1
+                ylim -= 1
+
+            if xoff == xlim:
+                for y in range(yoff, ylim):
+                    self.ychanged[y] = 1
+            elif yoff == ylim:
+                for x in range(xoff, xlim):
+                    self.xchanged[x] = 1
+            else:
+                xmid, ymid, lo_minimal, hi_minimal = self._diag(
+                    xoff, xlim, yoff, ylim, find_minimal)
+                stack.append((xmid, xlim, ymid, ylim, hi_minimal))
+                stack.append((xoff, xmid, yoff, ymid, lo_minimal))
+
+
+def _shift_boundaries(equivs, changed, other_changed):
+    """ Moves the changed regions to the positions GNU diff uses. changed and
+    other_changed have a sentinel entry at both ends. """
+    i = 0
+    j = 0
+    i_end = len(equivs)
+    # index offset of the sentinel
+    s = 1
+
+    while True:
+        while i < i_end and not changed[s + i]:
+            while other_changed[s + j]:
+                j += 1
+            j += 1
+            i += 1
+
+        if i == i_end:
+            break
+
+        start = i
+
+        i += 1
+        while changed[s + i]:
+            i += 1
+        while other_changed[s + j]:
+            j += 1
+
+        while True:
+            runlength = i - start
+
+            # move the changed region back, so long as the previous unchanged
+            # line matches the last changed one
+            while start and equivs[start - 1] == equivs[i - 1]:
+                start -= 1
+                changed[s + start] = 1
+                i -= 1
+                changed[s + i] = 0
+                while changed[s + start - 1]:
+                    start -= 1
+                j -= 1
+                while other_changed[s + j]:
+                    j -= 1
+
+            corresponding = i if other_changed[s + j - 1] else i_end
+
+            # move the changed region forward, so long as the first changed
+            # line matches the following unchanged one
+            while i != i_end and equivs[start] == equivs[i]:
+                changed[s + start] = 0
+                start += 1
+                changed[s + i] = 1
+                i += 1
+                while changed[s + i]:
+                    i += 1
+                j += 1
+                while other_changed[s + j]:
+                    corresponding = i
+                    j += 1
+
+            if runlength == i - start:
+                break
+
+        # move the merged run back to a corresponding run in the other file
+        while corresponding < i:
+            start -= 1
+            changed[s + start] = 1
+            i -= 1
+            changed[s + i] = 0
+            j -= 1
+            while other_changed[s + j]:
+                j -= 1
+
+
+def diff_lines(a, b):
+    """ Compares the bytes a and b. Returns the lines of a, the lines of b and
+    a list of (line0, line1, deleted, inserted) tuples of the changes in the
+    order of the lines. """
+    prefix_end, suffix0, suffix1 = _find_identical_ends(a, b, CONTEXT)
+    lines = [split_lines(a), split_lines(b)]
+    prefix_lines = a.count(b"\n", 0, prefix_end)
+    middle = [lines[0][prefix_lines:len(lines[0]) -
+                       len(split_lines(a[suffix0:]))],
+              lines[1][prefix_lines:len(lines[1]) -
+                       len(split_lines(b[suffix1:]))]]
+
+    classes = dict()
+    equivs = [[classes.setdefault(line, len(classes)) for line in middle[f]]
+              for f in (0, 1)]
+    counts = [[0] * len(classes), [0] * len(classes)]
+    for f in (0, 1):
+        for equiv in equivs[f]:
+            counts[f][equiv] += 1
+
+    # changed flags with sentinels at both ends
+    changed = [[0] * (len(middle[f]) + 2) for f in (0, 1)]
+    undiscarded = [[], []]
+    realindexes = [[], []]
+    for f in (0, 1):
+        discards = _discard_confusing_lines(equivs[f], counts[1 - f])
+        for i, discard in enumerate(discards):
+            if discard:
+                changed[f][i + 1] = 1
+            else:
+                undiscarded[f].append(equivs[f][i])
+                realindexes[f].append(i)
+
+    xchanged = [0] * len(undiscarded[0])
+    ychanged = [0] * len(undiscarded[1])
+    _Compare(undiscarded[0], undiscarded[1], xchanged, ychanged).compare()
+    for f, flags in ((0, xchanged), (1, ychanged)):
+        for i, flag in enumerate(flags):
+            if flag:
+                changed[f][realindexes[f][i] + 1] = 1
+
+    _shift_boundaries(equivs[0], changed[0], changed[1])
+    _shift_boundaries(equivs[1], changed[1], changed[0])
+
+    changes = []
+    i0 = i1 = 0
+    n0 = len(middle[0])
+    n1 = len(middle[1])
+    changed0 = changed[0]
+    changed1 = changed[1]
+    while i0 < n0 or i1 < n1:
+        if changed0[i0 + 1] or changed1[i1 + 1]:
+            line0 = i0
+            line1 = i1
+            while changed0[i0 + 1]:
+                i0 += 1
+            while changed1[i1 + 1]:
+                i1 += 1
+            changes.append((prefix_lines + line0, prefix_lines + line1,
+                            i0 - line0, i1 - line1))
+        i0 += 1
+        i1 += 1
+    return lines[0], lines[1], changes
+
+
+def _format_range(start, end):
+    """ Formats the range of the lines start to end (inclusive) starting at
+    0 like GNU diff """
+    start += 1
+    end += 1
+    if end < start:
+        return "%d,0" % end
+    if end == start:
+        return "%d" % end
+    return "%d,%d" % (start, end - start + 1)
+
+
+def _write_line(out, prefix, line):
+    out.append(prefix)
+    out.append(line)
+    if not line.endswith(b"\n"):
+        out.append(b"\n")
+        out.append(NO_NEWLINE_MARKER)
+
+
+def unified_diff(a, b, left_header, right_header, context=CONTEXT):
+    """ Returns the unified diff of the bytes a and b like diff -u does.
+    left_header and right_header are the file names and optional timestamps
+    as bytes written after --- and +++. Returns empty bytes if a and b are
+    equal. """
+    if a == b:
+        return b""
+
+    lines0, lines1, changes = diff_lines(a, b)
+    if not changes:
+        return b""
+
+    out = [b"--- ", left_header, b"\n", b"+++ ", right_header, b"\n"]
+    n0 = len(lines0)
+    n1 = len(lines1)
+
+    pos = 0
+    while pos < len(changes):
+        # collect the changes that are close enough to share a hunk
+        end = pos + 1
+        while end < len(changes):
+            line0, line1, deleted, inserted = changes[end - 1]
+            if changes[end][0] - (line0 + deleted) >= 2 * context + 1:
+                break
+            end += 1
+        hunk = changes[pos:end]
+        pos = end
+
+        first0 = max(hunk[0][0] - context, 0)
+        first1 = max(hunk[0][1] - context, 0)
+        last0 = hunk[-1][0] + hunk[-1][2] - 1
+        last1 = hunk[-1][1] + hunk[-1][3] - 1
+        if last0 < n0 - context:
+            last0 += context
+        else:
+            last0 = n0 - 1
+        if last1 < n1 - context:
+            last1 += context
+        else:
+            last1 = n1 - 1
+
+        out.append(("@@ -%s +%s @@\n" % (_format_range(first0, last0),
+                                         _format_range(first1, last1))
+                    ).encode("ascii"))
+
+        i = first0
+        j = first1
+        for line0, line1, deleted, inserted in hunk:
+            while i < line0:
+                _write_line(out, b" ", lines0[i])
+                i += 1
+                j += 1
+            for line in lines0[i:i + deleted]:
+                _write_line(out, b"-", line)
+            for line in lines1[j:j + inserted]:
+                _write_line(out, b"+", line)
+            i += deleted
+            j += inserted
+        while i <= last0:
+            _write_line(out, b" ", lines0[i])
+            i += 1
+
+    return b"".join(out)
@@ -22,6 +22,9 @@ from quilt.error import QuiltError
 if str is bytes:  # Python < 3
     def _encode_str(s):
         return s
+
+    def _decode_str(s):
+        return s
 else:  # Python 3
     from locale import getpreferredencoding
     _encoding = getpreferredencoding(do_setlocale=False)
@@ -29,6 +32,80 @@ else:  # Python 3
     def _encode_str(s):
         return s.encode(_encoding)
 
+    def _decode_str(s):
+        return s.decode(_encoding, "surrogateescape")
+
+
+# ioctl to share the data blocks of a file with another one on btrfs and xfs
+FICLONE = 0x40049409
+
+# methods to copy the contents of files, each one falls back to the methods
+# after it
+COPY_METHODS = ["reflink", "copy_file_range", "copy"]
+
+# method used by copy_file if none is passed. Can be changed with
+# set_copy_method.
+_copy_method = COPY_METHODS[0]
+
+
+def set_copy_method(method):
+    """ Sets the default method of copy_file """
+    global _copy_method
+    if method not in COPY_METHODS:
+        raise QuiltError("Unknown copy method %r. Supported methods are %s" %
+                         (method, ", ".join(COPY_METHODS)))
+    _copy_method = method
+
+
+def _reflink(src, dst):
+    import fcntl
+    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _copy_file_range(src, dst):
+    while os.copy_file_range(src.fileno(), dst.fileno(), 1024 * 1024 * 1024):
+        pass
+
+
+def copy_file(src, dst, method=None):
+    """ Copies the file src to dst like shutil.copy2 does. If dst is a
+    directory the file is copied into it.
+
+    method is one of COPY_METHODS. By default the method set with
+    set_copy_method is used. "reflink" shares the data blocks with src if the
+    file system supports it, "copy_file_range" lets the kernel copy the
+    contents and "copy" reads and writes the contents.
+    """
+    if method is None:
+        method = _copy_method
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            raise shutil.Error("%r and %r are the same file" % (src, dst))
+        if os.stat(dst).st_nlink > 1:
+            # don't modify other hard links like backups in an object store
+            os.remove(dst)
+
+    methods = COPY_METHODS[COPY_METHODS.index(method):-1]
+    with open(src, "rb") as fsrc:
+        with open(dst, "wb") as fdst:
+            for name in methods:
+                try:
+                    if name == "reflink":
+                        _reflink(fsrc, fdst)
+                    else:
+                        _copy_file_range(fsrc, fdst)
+                    break
+                except (AttributeError, ImportError, IOError, OSError):
+                    # not supported by the platform or file system
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+            else:
+                shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(src, dst)
+
 
 class SubprocessError(QuiltError):
 
@@ -78,6 +155,27 @@ class Process(object):
             raise SubprocessError(self.cmd, ret)
 
 
+def _scandir(dirname):
+    """ Generator of (name, is_dir) tuples of the entries of dirname. The
+    file type is taken from the directory entries if possible to avoid a
+    stat call for each entry. """
+    scandir = getattr(os, "scandir", None)
+    if scandir is None:
+        # Python < 3.5
+        for name in os.listdir(dirname):
+            yield name, os.path.isdir(os.path.join(dirname, name))
+        return
+    it = scandir(dirname)
+    try:
+        for entry in it:
+            yield entry.name, entry.is_dir()
+    finally:
+        # ScandirIterator.close is not available before Python 3.6
+        close = getattr(it, "close", None)
+        if close:
+            close()
+
+
 class Directory(object):
     """Handle directories on filesystems """
 
@@ -97,38 +195,42 @@ class Directory(object):
         if self.dirname and not os.path.exists(self.dirname):
             os.makedirs(self.dirname)
 
-    def _content(self, startdir, dirname=None):
-        files = []
-        dirs = []
-        if dirname:
-            dir = os.path.join(startdir, dirname)
-        else:
-            dir = startdir
-        contents = os.listdir(dir)
-        for content in contents:
-            if not dirname:
-                name = content
-            else:
-                name = os.path.join(dirname, content)
-            path = os.path.join(dir, content)
-            if os.path.isdir(path):
-                (newdirs, newfiles) = self._content(startdir, name)
-                dirs.append(name)
-                files.extend(newfiles)
-                dirs.extend(newdirs)
+    def walk(self):
+        """ Generator of (name, is_dir) tuples for all files and directories
+        in this directory and its subdirectories. The names are relative to
+        this directory. Each directory is returned before its content.
+        """
+        stack = [(None, _scandir(self.dirname))]
+        while stack:
+            dirname, entries = stack[-1]
+            for entry_name, is_dir in entries:
+                if dirname:
+                    name = os.path.join(dirname, entry_name)
+                else:
+                    name = entry_name
+                yield name, is_dir
+                if is_dir:
+                    stack.append((name, _scandir(os.path.join(self.dirname,
+                                                              name))))
+                    break
             else:
-                files.append(name)
-        return (dirs, files)
+                stack.pop()
 
     def files(self):
         """ Returns all files in this directory and its subdirectories"""
-        (dirs, files) = self._content(self.dirname)
-        return files
+        return [name for name, is_dir in self.walk() if not is_dir]
 
     def content(self):
         """ Returns all directories and files in this directory and its
             subdirectories """
-        return self._content(self.dirname)
+        files = []
+        dirs = []
+        for name, is_dir in self.walk():
+            if is_dir:
+                dirs.append(name)
+            else:
+                files.append(name)
+        return (dirs, files)
 
     def delete(self):
         """ Delete the directory and its content if directory exists"""
@@ -149,8 +251,9 @@ class Directory(object):
         """ Returns True if the directory doesn't contain any files or
         subdirectories
         """
-        contents = os.listdir(self.dirname)
-        return len(contents) == 0
+        for entry in _scandir(self.dirname):
+            return False
+        return True
 
     def copy(self, dest, symlinks=False):
         """ Copy to destination directory recursively.
@@ -231,7 +334,7 @@ class File(object):
         elif isinstance(dest, Directory):
             dest = dest.dirname
 
-        shutil.copy2(self.filename, dest)
+        copy_file(self.filename, dest)
 
     def is_empty(self):
         """ Returns True if the size of the file is 0 """
@@ -308,6 +411,10 @@ class TmpFile(File):
         self.delete_if_exists()
 
 
+# inspect.getargspec has been removed in Python 3.11
+_getargspec = getattr(inspect, "getfullargspec", None) or inspect.getargspec
+
+
 class FunctionWrapper(object):
     """ FunctionWrapper class to encapsulate function that are decorated by
     a Param class.
@@ -320,7 +427,7 @@ class FunctionWrapper(object):
 
     def _get_varnames(self):
         if inspect.isfunction(self.func):
-            return inspect.getargspec(self.func)[0]
+            return _getargspec(self.func)[0]
         elif isinstance(self.func, FunctionWrapper):
             return self.func._get_varnames()
 
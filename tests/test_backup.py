@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf-8 et sw=4 ts=4 tw=80:
+
+# python-quilt - A Python implementation of the quilt patch system
+#
+# See LICENSE comming with the source of python-quilt for details.
+
+import os
+import os.path
+
+from unittest import TestCase
+
+from quilt.backup import ObjectStore
+from quilt.utils import TmpDirectory
+
+
+class ObjectStoreTest(TestCase):
+
+    def test_add(self):
+        with TmpDirectory() as dir:
+            cwd = dir.get_name()
+            pc = os.path.join(cwd, "pc")
+            store = ObjectStore(pc)
+            self.assertFalse(store.exists())
+            store.create()
+            self.assertTrue(store.exists())
+
+            for name in ("a", "b"):
+                with open(os.path.join(cwd, name), "wb") as f:
+                    f.write(b"same\n")
+            backup_a = os.path.join(pc, "p1", "a")
+            backup_b = os.path.join(pc, "p2", "dir", "b")
+            store.add_file(os.path.join(cwd, "a"), backup_a)
+            store.add_file(os.path.join(cwd, "b"), backup_b)
+            store.add_data(b"other\n", 0o644, os.path.join(pc, "p2", "c"))
+
+            # equal contents are stored once
+            self.assertTrue(os.path.samefile(backup_a, backup_b))
+            self.assertEqual(3, os.stat(backup_a).st_nlink)
+            with open(os.path.join(pc, "p2", "c"), "rb") as f:
+                self.assertEqual(b"other\n", f.read())
+
+            # objects are only removed if no backup refers to them
+            os.remove(backup_a)
+            store.collect()
+            self.assertEqual(2, len(store.objects_dir.files()))
+            os.remove(backup_b)
+            store.collect()
+            self.assertEqual(1, len(store.objects_dir.files()))
+
+            os.remove(os.path.join(pc, "p2", "c"))
+            store.collect()
+            self.assertEqual([], store.objects_dir.files())
+
+    def test_release(self):
+        with TmpDirectory() as dir:
+            cwd = dir.get_name()
+            pc = os.path.join(cwd, "pc")
+            store = ObjectStore(pc)
+            store.create()
+
+            store.add_data(b"same\n", 0o644, os.path.join(pc, "p1", "a"))
+            store.add_data(b"other\n", 0o644, os.path.join(pc, "p1", "b"))
+            store.record(os.path.join(pc, "p1"))
+            store.add_data(b"same\n", 0o644, os.path.join(pc, "p2", "a"))
+            self.assertTrue(os.path.exists(os.path.join(pc, "p1~objects")))
+
+            # only the objects of p1 which aren't referenced anymore are
+            # removed
+            for name in ("a", "b"):
+                os.remove(os.path.join(pc, "p1", name))
+            store.release(os.path.join(pc, "p1"))
+            self.assertEqual(1, len(store.objects_dir.files()))
+            self.assertFalse(os.path.exists(os.path.join(pc, "p1~objects")))
+
+            # the objects of p2 haven't been recorded yet
+            os.remove(os.path.join(pc, "p2", "a"))
+            store.release(os.path.join(pc, "p2"))
+            self.assertEqual([], store.objects_dir.files())
@@ -16,7 +16,8 @@ from helpers import QuiltTest, tmp_mapping
 test_dir = os.path.dirname(__file__)
 sys.path.append(os.path.join(test_dir, os.pardir))
 
-from quilt.db import Db, DBError, DB_VERSION, PatchSeries, Series
+from quilt.db import Db, DBError, DB_VERSION, FileIndex, PatchLine, \
+                     PatchSeries, Series
 from quilt.db import Patch
 from quilt.utils import TmpDirectory
 
@@ -36,6 +37,82 @@ class DbTest(QuiltTest):
                 file.write(version.encode("ascii"))
             self.assertRaises(DBError, Db, dir.get_name())
 
+    def test_journal(self):
+        with TmpDirectory() as dir:
+            db = Db(dir.get_name())
+            db.add_patch(Patch("first"))
+            db.add_patch(Patch("second"))
+            db.save()
+            self.assertFalse(db.journal.exists())
+
+            # the applied-patches file isn't saved, e.g. after a crash
+            db.remove_patch(Patch("second"))
+            db.add_patch(Patch("third"))
+            self.assertTrue(db.journal.exists())
+            with open(db.journal.filename, "ab") as f:
+                f.write(b"+ incomplete")
+
+            db = Db(dir.get_name())
+            self.assertEqual(patch_list(["first", "third"]), db.patches())
+            self.assertFalse(db.journal.exists())
+
+    def test_save(self):
+        with TmpDirectory() as dir:
+            db = Db(dir.get_name())
+            db.add_patch(Patch("first"))
+            db.add_patch(Patch("second"))
+            db.save()
+            inode = os.stat(db.series_file).st_ino
+
+            # patches are appended and truncated in place
+            db.add_patch(Patch("third"))
+            db.save()
+            db.remove_patch(Patch("third"))
+            db.remove_patch(Patch("second"))
+            db.save()
+            self.assertEqual(inode, os.stat(db.series_file).st_ino)
+            with open(db.series_file, "rb") as f:
+                self.assertEqual(b"first\n", f.read())
+
+            db = Db(dir.get_name())
+            db.add_patches([Patch("zeroth")])
+            db.save()
+            with open(db.series_file, "rb") as f:
+                self.assertEqual(b"zeroth\nfirst\n", f.read())
+
+    def test_file_index(self):
+        with TmpDirectory() as dir:
+            pc = dir.get_name()
+            db = Db(pc)
+            for name, files in (("p1", ["a", "dir/b"]), ("p2", ["a"])):
+                for file in files + [".timestamp"]:
+                    path = os.path.join(pc, name, file)
+                    if not os.path.exists(os.path.dirname(path)):
+                        os.makedirs(os.path.dirname(path))
+                    open(path, "wb").close()
+                db.add_patch(Patch(name))
+            db.save()
+
+            index = FileIndex(db)
+            self.assertFalse(index.valid)
+            index.build()
+            index.save()
+            self.assertEqual(["p2"], index.patches_after("a", "p1"))
+            self.assertEqual([], index.patches_after("dir/b", "p1"))
+
+            index = FileIndex(db)
+            self.assertTrue(index.valid)
+            index.add_patch("p3", ["dir/b"])
+            self.assertEqual(["p3"], index.patches_after("dir/b", "p1"))
+            index.remove_patch("p3")
+            index.remove_file("p2", "a")
+            self.assertEqual([], index.patches_after("a", "p1"))
+
+            # the index doesn't match the applied patches anymore
+            db.remove_patch(Patch("p2"))
+            db.save()
+            self.assertFalse(FileIndex(db).valid)
+
     def test_series(self):
         firstpatch = Patch("firstpatch")
         lastpatch = Patch("lastpatch")
@@ -97,6 +174,10 @@ class DbTest(QuiltTest):
             with tmp_mapping(vars(sys)) as tmp_sys:
                 tmp_sys.set("stderr", cStringIO())
                 series.read()
+                # the options are parsed on demand
+                [patch] = series.patches()
+                self.assertEqual("", sys.stderr.getvalue())
+                self.assertEqual(1, patch.strip)
                 self.assertIn("-X", sys.stderr.getvalue())
 
     def test_add_remove(self):
@@ -163,6 +244,102 @@ class DbTest(QuiltTest):
         self.assertEqual(newfirst1, db.first_patch())
         self.assertEqual(lastpatch, db.top_patch())
 
+    def test_positions(self):
+        with TmpDirectory() as dir:
+            series = Series(dir.get_name())
+            with open(series.series_file, "wb") as file:
+                file.write(b"p1\n# comment\np2\np3\np4\n")
+            series.read()
+            p1, p2, p3, p4, p5 = patch_list(["p1", "p2", "p3", "p4", "p5"])
+
+            self.assertEqual(p2, series.patch_after(p1))
+            self.assertEqual(p1, series.patch_before(p2))
+            self.assertEqual(None, series.patch_before(p1))
+            self.assertEqual(None, series.patch_after(p4))
+
+            series.remove_patch(p2)
+            self.assertEqual(p3, series.patch_after(p1))
+            series.add_patches([p2], p3)
+            self.assertEqual(patch_list(["p1", "p3", "p2", "p4"]),
+                             series.patches())
+            self.assertEqual(p4, series.patch_after(p2))
+            series.replace(p3, p5)
+            self.assertEqual(p5, series.patch_before(p2))
+            series.insert_patches([p3])
+            self.assertEqual(patch_list(["p3", "p1", "p5", "p2"]),
+                             series.patches_until(p2))
+            series.add_patch(Patch("p6"))
+            self.assertEqual(patch_list(["p4", "p6"]),
+                             series.patches_after(p2))
+
+    def test_snapshot(self):
+        with TmpDirectory() as dir:
+            pc_dir = os.path.join(dir.get_name(), "pc")
+            cache_dir = os.path.join(pc_dir, ".cache")
+            series = Series(dir.get_name(), cache_dir)
+            with open(series.series_file, "wb") as file:
+                file.write(b"p1 -p0 # comment\n# comment\np2 -R\n")
+            # pretend the series file is old enough to trust its mtime
+            os.utime(series.series_file, (1000000000, 1000000000))
+            series.read()
+            self.assertFalse(os.path.exists(pc_dir))
+
+            Db(pc_dir).create()
+            series.read()
+            snapshot_dir = os.path.join(cache_dir, "series")
+            self.assertEqual(1, len(os.listdir(snapshot_dir)))
+
+            # the size and mtime are unchanged, the snapshot is used
+            with open(series.series_file, "wb") as file:
+                file.write(b"p3 -p0 # comment\n# comment\np4 -R\n")
+            os.utime(series.series_file, (1000000000, 1000000000))
+            series = Series(dir.get_name(), cache_dir)
+            [patch1, patch2] = series.patches()
+            self.assertEqual(Patch("p1"), patch1)
+            self.assertEqual("0", patch1.strip)
+            self.assertIs(True, patch2.reverse)
+            self.assertEqual(" comment",
+                             series.patch2line[patch1].get_comment())
+            self.assertEqual(patch2, series.patch_after(patch1))
+
+            # a changed mtime invalidates the snapshot, it is replaced
+            os.utime(series.series_file, (1000000001, 1000000001))
+            series.read()
+            self.assertEqual(patch_list(["p3", "p4"]), series.patches())
+            self.assertEqual(1, len(os.listdir(snapshot_dir)))
+
+            with open(series.series_file, "wb") as file:
+                file.write(b"p5 -p0 # comment\n# comment\np6 -R\n")
+            os.utime(series.series_file, (1000000001, 1000000001))
+            series = Series(dir.get_name(), cache_dir)
+            self.assertEqual(patch_list(["p3", "p4"]), series.patches())
+
+    def test_comments(self):
+        self.assertEqual("# comment", PatchLine("# comment\n").get_comment())
+        # the comment of an indented comment line doesn't include the #
+        line = PatchLine("  # comment")
+        self.assertEqual(" comment", line.get_comment())
+        self.assertEqual(None, line.get_patch())
+        self.assertEqual(" comment", PatchLine("p1 -p0 # comment")
+                         .get_comment())
+        self.assertEqual("", PatchLine("p1").get_comment())
+
+    def test_shared_patches(self):
+        with TmpDirectory() as dir:
+            series = Series(dir.get_name())
+            with open(series.series_file, "wb") as file:
+                file.write(b"p1\np2 -p0\n")
+            series.read()
+            db = Db(dir.get_name())
+            with open(db.series_file, "wb") as file:
+                file.write(b"p1\np2\n")
+            db.read()
+            self.assertIs(series.patches()[0], db.patches()[0])
+            # patches with different options are different objects
+            self.assertIsNot(series.patches()[1], db.patches()[1])
+            self.assertEqual("0", series.patches()[1].strip)
+            self.assertEqual(1, db.patches()[1].strip)
+
     def test_replace(self):
         db = PatchSeries(os.path.join(test_dir, "data", "db"),
                          "series_replace1")
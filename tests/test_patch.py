@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf-8 et sw=4 ts=4 tw=80:
+
+# python-quilt - A Python implementation of the quilt patch system
+#
+# See LICENSE comming with the source of python-quilt for details.
+
+import os.path
+
+from helpers import QuiltTest
+
+from quilt.patch import Diff, DiffCache, LineIndex, Patch, PatchApplyError, \
+                        PatchCache, PatchParser, PatchReader, RollbackPatch, \
+                        UnsupportedPatchFormat, apply_hunks
+from quilt.utils import TmpDirectory
+
+PATCH = b"""\
+Header of the patch
+
+Index: dir/f
+===================================================================
+--- dir.orig/f
++++ dir/f
+@@ -1,7 +1,7 @@
+ a
+ b
+ c
+-d
++D
+ e
+ f
+ g
+"""
+
+
+def lines(string):
+    return [line + b"\n" for line in string.split()]
+
+
+class PatchTest(QuiltTest):
+
+    def _hunks(self):
+        [file_patch] = PatchParser(PATCH.splitlines(True)).file_patches()
+        self.assertEqual("dir.orig/f", file_patch.old_name)
+        self.assertEqual("dir/f", file_patch.new_name)
+        return file_patch.hunks
+
+    def test_apply_hunks(self):
+        result, [hunk] = apply_hunks(lines(b"a b c d e f g"), self._hunks())
+        self.assertEqual(lines(b"a b c D e f g"), result)
+        self.assertFalse(hunk.mismatch())
+
+    def test_apply_hunks_offset(self):
+        result, [hunk] = apply_hunks(lines(b"x y a b c d e f g"),
+                                     self._hunks())
+        self.assertEqual(lines(b"x y a b c D e f g"), result)
+        self.assertEqual(2, hunk.offset)
+        self.assertEqual("Hunk #1 succeeded at 3 (offset 2 lines).",
+                         str(hunk))
+
+    def test_apply_hunks_fuzz(self):
+        result, [hunk] = apply_hunks(lines(b"X b c d e f Y"), self._hunks())
+        self.assertEqual(lines(b"X b c D e f Y"), result)
+        self.assertEqual(1, hunk.fuzz)
+
+        result, [hunk] = apply_hunks(lines(b"a b X d e f g"), self._hunks())
+        self.assertTrue(hunk.failed())
+        self.assertEqual(lines(b"a b X d e f g"), result)
+
+    def test_apply_hunks_before_start(self):
+        # the fuzzy leading context must not start before the first line.
+        # GNU patch applies the first hunk at line 5 and rejects the second.
+        [file_patch] = PatchParser((b"--- a/f\n+++ b/f\n"
+                                    b"@@ -1,4 +1,4 @@\n a\n-a\n+X\n c\n c\n"
+                                    b"@@ -6,3 +6,3 @@\n b\n a\n-c\n+X\n"
+                                    ).splitlines(True)).file_patches()
+        result, [hunk1, hunk2] = apply_hunks(lines(b"a c c c b a b c"),
+                                             file_patch.hunks)
+        self.assertEqual(lines(b"a c c c b X b c"), result)
+        self.assertEqual("Hunk #1 succeeded at 5 with fuzz 2 (offset 4 "
+                         "lines).", str(hunk1))
+        self.assertTrue(hunk2.failed())
+
+    def test_apply_hunks_frozen(self):
+        # a hunk must not overlap the lines changed by the previous hunk
+        # including its fuzzy leading context. GNU patch rejects the second
+        # hunk.
+        [file_patch] = PatchParser((b"--- a/f\n+++ b/f\n"
+                                    b"@@ -5,5 +5,5 @@\n b\n a\n-b\n+X\n"
+                                    b" c\n c\n"
+                                    b"@@ -12,3 +12,3 @@\n b\n b\n-a\n+X\n"
+                                    ).splitlines(True)).file_patches()
+        result, [hunk1, hunk2] = apply_hunks(
+            lines(b"b a c c b a b c a c b c b b"), file_patch.hunks)
+        self.assertEqual(lines(b"b a c c b a X c a c b c b b"), result)
+        self.assertFalse(hunk1.failed())
+        self.assertTrue(hunk2.failed())
+
+    def test_reader(self):
+        reader = PatchReader(iter(PATCH.splitlines(True) * 2))
+        self.assertEqual(b"Header of the patch\n\n", reader.header())
+        file_patches = reader.file_patches()
+        file_patch, hunks = next(file_patches)
+        self.assertEqual("dir/f", file_patch.new_name)
+        # unread hunks are skipped
+        file_patch, hunks = next(file_patches)
+        [hunk] = list(hunks)
+        self.assertEqual(b"+D\n", hunk.lines[4])
+        self.assertEqual([], list(file_patches))
+
+    def test_line_index(self):
+        index = LineIndex(lines(b"a b a b c a b"))
+        pattern = lines(b"a b")
+        self.assertEqual(0, index.find(pattern, 0, 0, 5))
+        # the position after expected wins if the distance is equal
+        self.assertEqual(5, index.find(pattern, 4, 0, 5))
+        self.assertEqual(2, index.find(pattern, 3, 0, 4))
+        self.assertEqual(None, index.find(pattern, 0, 3, 4))
+        self.assertEqual(None, index.find(lines(b"a c"), 0, 0, 5))
+
+    def test_apply(self):
+        with TmpDirectory() as dir:
+            cwd = dir.get_name()
+            with open(os.path.join(cwd, "patch"), "wb") as f:
+                f.write(PATCH)
+                f.write(b"--- /dev/null\n+++ dir/new\n@@ -0,0 +1 @@\n+new\n")
+            with open(os.path.join(cwd, "f"), "wb") as f:
+                f.write(b"".join(lines(b"a b c d e f g")))
+
+            Patch("patch").apply(cwd, backup=True, prefix="backup",
+                                 quiet=True)
+
+            with open(os.path.join(cwd, "f"), "rb") as f:
+                self.assertEqual(b"".join(lines(b"a b c D e f g")), f.read())
+            with open(os.path.join(cwd, "backup", "f"), "rb") as f:
+                self.assertEqual(b"".join(lines(b"a b c d e f g")), f.read())
+            with open(os.path.join(cwd, "new"), "rb") as f:
+                self.assertEqual(b"new\n", f.read())
+            # new files are backed up as empty files
+            self.assertEqual(0, os.path.getsize(os.path.join(cwd, "backup",
+                                                             "new")))
+
+            Patch("patch").apply(cwd, reverse=True, quiet=True)
+            with open(os.path.join(cwd, "f"), "rb") as f:
+                self.assertEqual(b"".join(lines(b"a b c d e f g")), f.read())
+            self.assertFalse(os.path.exists(os.path.join(cwd, "new")))
+
+    def test_apply_epoch(self):
+        # diff -N marks missing files with a timestamp of the Epoch
+        with TmpDirectory() as dir:
+            cwd = dir.get_name()
+            with open(os.path.join(cwd, "patch"), "wb") as f:
+                f.write(b"--- a/gone\t2017-01-01 12:00:00.000000000 +0000\n"
+                        b"+++ b/gone\t1970-01-01 00:00:00.000000000 +0000\n"
+                        b"@@ -1 +0,0 @@\n-x\n"
+                        b"--- a/new\t1970-01-01 01:00:00.000000000 +0100\n"
+                        b"+++ b/new\t2017-01-01 12:00:00.000000000 +0000\n"
+                        b"@@ -0,0 +1 @@\n+y\n")
+            with open(os.path.join(cwd, "gone"), "wb") as f:
+                f.write(b"x\n")
+
+            [deletion, creation] = Patch("patch").get_file_patches(cwd)
+            self.assertTrue(deletion.is_deletion())
+            self.assertFalse(deletion.is_creation())
+            self.assertTrue(creation.is_creation())
+
+            Patch("patch").apply(cwd, quiet=True)
+            self.assertFalse(os.path.exists(os.path.join(cwd, "gone")))
+            with open(os.path.join(cwd, "new"), "rb") as f:
+                self.assertEqual(b"y\n", f.read())
+
+            Patch("patch").apply(cwd, reverse=True, quiet=True)
+            with open(os.path.join(cwd, "gone"), "rb") as f:
+                self.assertEqual(b"x\n", f.read())
+            self.assertFalse(os.path.exists(os.path.join(cwd, "new")))
+
+    def test_unsupported(self):
+        for patch in (b"header only\n",
+                      b"1c1\n< a\n---\n> b\n",
+                      b"diff --git a/f b/g\nsimilarity index 100%\n"
+                      b"rename from f\nrename to g\n",
+                      b"diff --git a/f b/f\nold mode 100644\n"
+                      b"new mode 100755\n",
+                      b"diff --git a/e b/e\nnew file mode 100644\n"
+                      b"index 0000000..e69de29\n" + PATCH):
+            with self.assertRaises(UnsupportedPatchFormat):
+                PatchParser(patch.splitlines(True)).file_patches()
+        # plain git diffs are applied in-process
+        diff = PATCH[PATCH.index(b"--- "):]
+        [file_patch] = PatchParser((b"diff --git a/f b/f\nindex 1..2 100644\n"
+                                    + diff).splitlines(True)).file_patches()
+        self.assertEqual("dir/f", file_patch.new_name)
+        self.assertEqual([], PatchParser([]).file_patches())
+
+    def test_apply_git_rename(self):
+        # git renames and mode changes are applied by the patch util
+        with TmpDirectory() as dir:
+            cwd = dir.get_name()
+            with open(os.path.join(cwd, "patch"), "wb") as f:
+                f.write(b"diff --git a/f b/g\nold mode 100644\n"
+                        b"new mode 100755\nsimilarity index 100%\n"
+                        b"rename from f\nrename to g\n")
+            with open(os.path.join(cwd, "f"), "wb") as f:
+                f.write(b"f\n")
+            os.chmod(os.path.join(cwd, "f"), 0o644)
+
+            Patch("patch").apply(cwd, backup=True, prefix="backup",
+                                 quiet=True)
+            self.assertFalse(os.path.exists(os.path.join(cwd, "f")))
+            with open(os.path.join(cwd, "g"), "rb") as f:
+                self.assertEqual(b"f\n", f.read())
+            self.assertTrue(os.stat(os.path.join(cwd, "g")).st_mode & 0o100)
+            with open(os.path.join(cwd, "backup", "f"), "rb") as f:
+                self.assertEqual(b"f\n", f.read())
+
+    def test_apply_failed(self):
+        with TmpDirectory() as dir:
+            cwd = dir.get_name()
+            with open(os.path.join(cwd, "patch"), "wb") as f:
+                f.write(PATCH)
+            with open(os.path.join(cwd, "f"), "wb") as f:
+                f.write(b"".join(lines(b"a b X d e f g")))
+
+            with self.assertRaises(PatchApplyError) as caught:
+                Patch("patch").apply(cwd, no_backup_if_mismatch=True,
+                                     quiet=True)
+            [(name, number, hunk)] = caught.exception.failed
+            self.assertEqual("f", name)
+            self.assertEqual(1, number)
+            self.assertTrue(os.path.exists(os.path.join(cwd, "f.rej")))
+            self.assertFalse(os.path.exists(os.path.join(cwd, "f.orig")))
+
+    def test_rollback_move(self):
+        with TmpDirectory() as dir:
+            cwd = dir.get_name()
+            backup_dir = os.path.join(cwd, "pc", "patch")
+            os.makedirs(os.path.join(backup_dir, "dir"))
+            os.mkdir(os.path.join(cwd, "dir"))
+            for name, backup, data in (("f", b"old\n", b"new\n"),
+                                       ("new", b"", b"new\n"),
+                                       (os.path.join("dir", "g"), b"g\n",
+                                        None)):
+                with open(os.path.join(backup_dir, name), "wb") as f:
+                    f.write(backup)
+                if data is not None:
+                    with open(os.path.join(cwd, name), "wb") as f:
+                        f.write(data)
+
+            rollback = RollbackPatch(cwd, backup_dir)
+            rollback.rollback(move=True)
+            with open(os.path.join(cwd, "f"), "rb") as f:
+                self.assertEqual(b"old\n", f.read())
+            with open(os.path.join(cwd, "dir", "g"), "rb") as f:
+                self.assertEqual(b"g\n", f.read())
+            self.assertFalse(os.path.exists(os.path.join(cwd, "new")))
+            # the backups have been moved
+            self.assertFalse(os.path.exists(os.path.join(backup_dir, "f")))
+            rollback.delete_backup()
+            self.assertFalse(os.path.exists(backup_dir))
+
+    def test_diff_equal(self):
+        with TmpDirectory() as dir:
+            cwd = dir.get_name()
+            for name, data in (("a", b"abc"), ("b", b"abc"), ("c", b"abd"),
+                               ("d", b"abcd")):
+                with open(os.path.join(cwd, name), "wb") as f:
+                    f.write(data)
+            a = os.path.join(cwd, "a")
+            self.assertTrue(Diff(a, os.path.join(cwd, "b")).equal(cwd))
+            self.assertFalse(Diff(a, os.path.join(cwd, "c")).equal(cwd))
+            self.assertFalse(Diff(a, os.path.join(cwd, "d")).equal(cwd))
+
+    def test_cache(self):
+        with TmpDirectory() as dir:
+            cwd = dir.get_name()
+            name = os.path.join(cwd, "patch")
+            with open(name, "wb") as f:
+                f.write(PATCH)
+            # pretend the patch file is old enough to trust its mtime
+            os.utime(name, (1000000000, 1000000000))
+
+            # nothing is stored outside of a quilt meta-data directory
+            cache = PatchCache(os.path.join(cwd, "cache"))
+            cache.get_file_patches(name)
+            self.assertFalse(os.path.exists(os.path.join(cwd, "cache")))
+
+            with open(os.path.join(cwd, ".version"), "wb") as f:
+                f.write(b"2\n")
+            cache = PatchCache(os.path.join(cwd, "cache"))
+            [file_patch] = cache.get_file_patches(name)
+            self.assertEqual("dir/f", file_patch.new_name)
+            self.assertEqual(b"Header of the patch\n\n",
+                             Patch(name).get_header(cache=cache))
+
+            # the size and mtime are unchanged, the cached result is used
+            with open(name, "wb") as f:
+                f.write(PATCH.replace(b"dir/f", b"dir/g"))
+            os.utime(name, (1000000000, 1000000000))
+            cache = PatchCache(os.path.join(cwd, "cache"))
+            [file_patch] = cache.get_file_patches(name)
+            self.assertEqual("dir/f", file_patch.new_name)
+
+            os.utime(name, (1000000001, 1000000001))
+            [file_patch] = cache.get_file_patches(name)
+            self.assertEqual("dir/g", file_patch.new_name)
+            # the parse result of the previous contents has been removed
+            self.assertEqual(1, len(os.listdir(os.path.join(cwd, "cache",
+                                                            "parsed"))))
+
+    def test_diff_cache_prune(self):
+        with TmpDirectory() as dir:
+            cache_dir = os.path.join(dir.get_name(), "cache")
+            with open(os.path.join(dir.get_name(), ".version"), "wb") as f:
+                f.write(b"2\n")
+            for name in ("p1.patch", "p2.patch"):
+                cache = DiffCache(cache_dir, name)
+                cache.set("f", (1, 2), b"diff")
+                cache.save()
+
+            cache = DiffCache(cache_dir, "p1.patch")
+            cache.prune(["p1.patch"])
+            self.assertEqual(1, len(os.listdir(os.path.join(cache_dir,
+                                                            "diff"))))
+            self.assertEqual(b"diff", DiffCache(cache_dir, "p1.patch").get(
+                "f", (1, 2)))
+
+
+if __name__ == "__main__":
+    PatchTest.run_tests()
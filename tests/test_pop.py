@@ -11,8 +11,11 @@ import os.path
 
 from helpers import QuiltTest
 
+from quilt.backup import Manifest
+from quilt.error import QuiltError
 from quilt.patch import Patch
 from quilt.pop import Pop
+from quilt.push import Push
 from quilt.utils import Directory, TmpDirectory, File
 
 test_dir = os.path.dirname(__file__)
@@ -47,6 +50,165 @@ class PopTest(QuiltTest):
             self.assertFalse(f1.exists())
             self.assertFalse(f2.exists())
 
+    def test_unapply_all_shared_file(self):
+        push_dir = Directory(os.path.join(test_dir, "data", "push", "test1"))
+
+        with TmpDirectory(dir=self.data_dir.get_name()) as tmp_dir:
+            tmp_test_dir = tmp_dir + "test1"
+            push_dir.copy(tmp_test_dir)
+
+            pc_dir = tmp_test_dir + "pc"
+            patches_dir = tmp_test_dir + "patches"
+            f1 = tmp_test_dir + File("f1")
+            f2 = tmp_test_dir + File("f2")
+
+            push = Push(tmp_test_dir.get_name(), pc_dir.get_name(),
+                        patches_dir.get_name())
+            push.apply_all(quiet=True)
+            # p1.patch creates f2 and p2.patch modifies it
+            self.assertTrue(f2.exists())
+
+            unapplied = []
+
+            def unapplied_patch(patch):
+                unapplied.append(patch)
+
+            pop = Pop(tmp_test_dir.get_name(), pc_dir.get_name())
+            pop.unapplied_patch.connect(unapplied_patch)
+            try:
+                pop.unapply_all(force=True)
+            finally:
+                pop.unapplied_patch.disconnect(unapplied_patch)
+            self.assertEqual([Patch("p2.patch"), Patch("p1.patch")],
+                             unapplied)
+            self.assertEqual(None, pop.db.top_patch())
+            self.assertFalse(f1.exists())
+            self.assertFalse(f2.exists())
+            self.assertFalse((pc_dir + "p1.patch").exists())
+            self.assertFalse((pc_dir + "p2.patch").exists())
+
+    def test_manifest(self):
+        push_dir = Directory(os.path.join(test_dir, "data", "push", "test1"))
+
+        with TmpDirectory(dir=self.data_dir.get_name()) as tmp_dir:
+            tmp_test_dir = tmp_dir + "test1"
+            push_dir.copy(tmp_test_dir)
+
+            pc_dir = tmp_test_dir + "pc"
+            patches_dir = tmp_test_dir + "patches"
+            push = Push(tmp_test_dir.get_name(), pc_dir.get_name(),
+                        patches_dir.get_name())
+            push.apply_all(quiet=True)
+
+            manifest = Manifest(pc_dir, "p2.patch")
+            self.assertTrue(manifest.read())
+            self.assertEqual(["f2"], list(manifest.files))
+
+            # pretend the files got the same mtime as the timestamp of the
+            # patch. They are unchanged according to the manifest.
+            timestamp = (pc_dir + File("p2.patch/.timestamp")).get_name()
+            os.utime(timestamp, (0, 0))
+            manifest.record(tmp_test_dir, ["f2"])
+            manifest.save()
+
+            with open((tmp_test_dir + File("f1")).get_name(), "wb") as f:
+                f.write(b"modified\n")
+
+            pop = Pop(tmp_test_dir.get_name(), pc_dir.get_name())
+            pop.unapply_top_patch()
+            self.assertFalse(manifest.exists())
+            with self.assertRaises(QuiltError):
+                pop.unapply_top_patch()
+
+    def test_touched(self):
+        push_dir = Directory(os.path.join(test_dir, "data", "push", "test1"))
+
+        with TmpDirectory(dir=self.data_dir.get_name()) as tmp_dir:
+            tmp_test_dir = tmp_dir + "test1"
+            push_dir.copy(tmp_test_dir)
+
+            pc_dir = tmp_test_dir + "pc"
+            patches_dir = tmp_test_dir + "patches"
+            push = Push(tmp_test_dir.get_name(), pc_dir.get_name(),
+                        patches_dir.get_name())
+            push.apply_all(quiet=True)
+
+            # touched files with unchanged contents are not modified
+            f2 = (tmp_test_dir + File("f2")).get_name()
+            st = os.stat((pc_dir + File("p2.patch/.timestamp")).get_name())
+            os.utime(f2, (st.st_atime, st.st_mtime + 10))
+            pop = Pop(tmp_test_dir.get_name(), pc_dir.get_name())
+            pop.unapply_top_patch()
+
+            with open(f2, "wb") as f:
+                f.write(b"3\n")
+            os.utime(f2, (st.st_atime, st.st_mtime + 10))
+            with self.assertRaises(QuiltError):
+                pop.unapply_top_patch()
+
+    def test_unapply_all_check(self):
+        push_dir = Directory(os.path.join(test_dir, "data", "push", "test1"))
+
+        with TmpDirectory(dir=self.data_dir.get_name()) as tmp_dir:
+            tmp_test_dir = tmp_dir + "test1"
+            push_dir.copy(tmp_test_dir)
+
+            pc_dir = tmp_test_dir + "pc"
+            patches_dir = tmp_test_dir + "patches"
+            push = Push(tmp_test_dir.get_name(), pc_dir.get_name(),
+                        patches_dir.get_name())
+            push.apply_all(quiet=True)
+
+            f1 = (tmp_test_dir + File("f1")).get_name()
+            with open(f1, "wb") as f:
+                f.write(b"modified\n")
+
+            # all patches are checked before any patch is removed
+            pop = Pop(tmp_test_dir.get_name(), pc_dir.get_name())
+            unapplied = []
+
+            def unapplying(patch):
+                unapplied.append(patch)
+
+            pop.unapplying.connect(unapplying)
+            try:
+                with self.assertRaises(QuiltError):
+                    pop.unapply_all(jobs=2)
+            finally:
+                pop.unapplying.disconnect(unapplying)
+            self.assertEqual([], unapplied)
+            self.assertEqual(Patch("p2.patch"), pop.db.top_patch())
+            with open((tmp_test_dir + File("f2")).get_name(), "rb") as f:
+                self.assertEqual(b"3\n", f.read())
+
+    def test_unapply_all_recreated(self):
+        with TmpDirectory(dir=self.data_dir.get_name()) as tmp_dir:
+            cwd = tmp_dir.get_name()
+            pc_dir = tmp_dir + "pc"
+            patches_dir = tmp_dir + "patches"
+            patches_dir.create()
+            with open(os.path.join(cwd, "f"), "wb") as f:
+                f.write(b"a\n")
+            with open((patches_dir + File("series")).get_name(), "wb") as f:
+                f.write(b"delete.patch\nrecreate.patch\n")
+            with open((patches_dir + File("delete.patch")).get_name(),
+                      "wb") as f:
+                f.write(b"--- a/f\n+++ /dev/null\n@@ -1 +0,0 @@\n-a\n")
+            with open((patches_dir + File("recreate.patch")).get_name(),
+                      "wb") as f:
+                f.write(b"--- /dev/null\n+++ b/f\n@@ -0,0 +1 @@\n+b\n")
+
+            push = Push(cwd, pc_dir.get_name(), patches_dir.get_name())
+            push.apply_all(quiet=True)
+
+            # the file is missing after the lower patch according to its
+            # manifest although the backup of the patch above is empty
+            pop = Pop(cwd, pc_dir.get_name())
+            pop.unapply_all()
+            self.assertEqual(None, pop.db.top_patch())
+            with open(os.path.join(cwd, "f"), "rb") as f:
+                self.assertEqual(b"a\n", f.read())
+
     def test_apply_next(self):
         patch1 = Patch("p1.patch")
         patch2 = Patch("p2.patch")
@@ -11,7 +11,9 @@ import os.path
 
 from helpers import QuiltTest
 
+from quilt.db import FileIndex
 from quilt.patch import Patch
+from quilt.pop import Pop
 from quilt.push import Push
 from quilt.utils import Directory, TmpDirectory, File
 
@@ -49,6 +51,207 @@ class PushTest(QuiltTest):
             self.assertTrue(f1.exists())
             self.assertTrue(f2.exists())
 
+    def test_apply_all_file_index(self):
+        test_dir = self.data_dir + "test1"
+
+        with TmpDirectory(dir=self.data_dir.get_name()) as tmp_dir:
+            tmp_test_dir = tmp_dir + "test1"
+            test_dir.copy(tmp_test_dir)
+
+            pc_dir = tmp_test_dir + "pc"
+            patches_dir = tmp_test_dir + "patches"
+
+            push = Push(tmp_test_dir.get_name(), pc_dir.get_name(),
+                        patches_dir.get_name())
+            push.file_index.build()
+            push.apply_all(quiet=True)
+
+            # the index is updated by push
+            index = FileIndex(push.db)
+            self.assertTrue(index.valid)
+            self.assertEqual(["p2.patch"], index.patches_after("f2",
+                                                              "p1.patch"))
+
+    def test_apply_all_batch(self):
+        patch1 = Patch("p1.patch")
+        patch2 = Patch("p2.patch")
+
+        test_dir = self.data_dir + "test1"
+
+        with TmpDirectory(dir=self.data_dir.get_name()) as tmp_dir:
+            tmp_test_dir = tmp_dir + "test1"
+            test_dir.copy(tmp_test_dir)
+
+            pc_dir = tmp_test_dir + "pc"
+            patches_dir = tmp_test_dir + "patches"
+
+            push = Push(tmp_test_dir.get_name(), pc_dir.get_name(),
+                        patches_dir.get_name())
+            push.apply_all(quiet=True, batch=True)
+            self.assertEqual(patch2, push.db.top_patch())
+
+            f2 = tmp_test_dir + File("f2")
+            with open(f2.get_name(), "rb") as f:
+                self.assertEqual(b"3\n", f.read())
+
+            # each patch has a backup of the state before it was applied
+            backup1 = pc_dir + File(os.path.join("p1.patch", "f2"))
+            self.assertTrue(backup1.is_empty())
+            backup2 = pc_dir + File(os.path.join("p2.patch", "f2"))
+            with open(backup2.get_name(), "rb") as f:
+                self.assertEqual(b"2\n", f.read())
+
+            pop = Pop(tmp_test_dir.get_name(), pc_dir.get_name())
+            pop.unapply_top_patch()
+            self.assertEqual(patch1, pop.db.top_patch())
+            with open(f2.get_name(), "rb") as f:
+                self.assertEqual(b"2\n", f.read())
+
+    def test_apply_all_batch_touched(self):
+        patch1 = Patch("p1.patch")
+
+        test_dir = self.data_dir + "test1"
+
+        with TmpDirectory(dir=self.data_dir.get_name()) as tmp_dir:
+            tmp_test_dir = tmp_dir + "test1"
+            test_dir.copy(tmp_test_dir)
+
+            pc_dir = tmp_test_dir + "pc"
+            patches_dir = tmp_test_dir + "patches"
+
+            push = Push(tmp_test_dir.get_name(), pc_dir.get_name(),
+                        patches_dir.get_name())
+            push.apply_all(quiet=True, batch=True)
+
+            # the manifest of p1.patch contains its own result, not the
+            # result of all patches
+            pop = Pop(tmp_test_dir.get_name(), pc_dir.get_name(),
+                      patches_dir.get_name())
+            pop.unapply_top_patch()
+            self.assertEqual(patch1, pop.db.top_patch())
+            f2 = tmp_test_dir + File("f2")
+            st = os.stat(f2.get_name())
+            os.utime(f2.get_name(), (st.st_atime, st.st_mtime + 100))
+            pop.unapply_top_patch()
+            self.assertEqual(None, pop.db.top_patch())
+
+    def test_apply_all_prefetch(self):
+        patch2 = Patch("p2.patch")
+
+        test_dir = self.data_dir + "test1"
+
+        with TmpDirectory(dir=self.data_dir.get_name()) as tmp_dir:
+            tmp_test_dir = tmp_dir + "test1"
+            test_dir.copy(tmp_test_dir)
+
+            pc_dir = tmp_test_dir + "pc"
+            patches_dir = tmp_test_dir + "patches"
+
+            push = Push(tmp_test_dir.get_name(), pc_dir.get_name(),
+                        patches_dir.get_name())
+            push.apply_all(quiet=True, prefetch=1)
+            self.assertEqual(patch2, push.db.top_patch())
+            # all prefetched results have been used
+            self.assertEqual({}, push.patch_cache.prefetched)
+
+            f2 = tmp_test_dir + File("f2")
+            with open(f2.get_name(), "rb") as f:
+                self.assertEqual(b"3\n", f.read())
+
+    def test_apply_all_object_store(self):
+        test_dir = self.data_dir + "test1"
+
+        with TmpDirectory(dir=self.data_dir.get_name()) as tmp_dir:
+            tmp_test_dir = tmp_dir + "test1"
+            test_dir.copy(tmp_test_dir)
+
+            pc_dir = tmp_test_dir + "pc"
+            patches_dir = tmp_test_dir + "patches"
+
+            push = Push(tmp_test_dir.get_name(), pc_dir.get_name(),
+                        patches_dir.get_name())
+            push.store.create()
+            push.apply_all(quiet=True)
+
+            # the backup is a hard link to an object
+            backup2 = pc_dir + File(os.path.join("p2.patch", "f2"))
+            with open(backup2.get_name(), "rb") as f:
+                self.assertEqual(b"2\n", f.read())
+            self.assertEqual(2, os.stat(backup2.get_name()).st_nlink)
+
+            pop = Pop(tmp_test_dir.get_name(), pc_dir.get_name())
+            pop.unapply_top_patch(force=True)
+            f2 = tmp_test_dir + File("f2")
+            with open(f2.get_name(), "rb") as f:
+                self.assertEqual(b"2\n", f.read())
+            # the object isn't referenced anymore
+            objects = (pc_dir + ".objects").files()
+            self.assertEqual([], objects)
+            self.assertFalse(os.path.exists(pc_dir.get_name() +
+                                            "/p2.patch~objects"))
+
+    def test_check_all(self):
+        patch1 = Patch("p1.patch")
+
+        test_dir = self.data_dir + "test1"
+
+        with TmpDirectory(dir=self.data_dir.get_name()) as tmp_dir:
+            tmp_test_dir = tmp_dir + "test1"
+            test_dir.copy(tmp_test_dir)
+
+            pc_dir = tmp_test_dir + "pc"
+            patches_dir = tmp_test_dir + "patches"
+            f1 = tmp_test_dir + File("f1")
+            f2 = tmp_test_dir + File("f2")
+
+            push = Push(tmp_test_dir.get_name(), pc_dir.get_name(),
+                        patches_dir.get_name())
+            self.assertEqual([], push.check_all(jobs=2))
+            self.assertFalse(f2.exists())
+            # the parsed patches aren't cached without meta-data directory
+            self.assertFalse(pc_dir.exists())
+
+            # p1.patch can't create f1 if it already exists
+            with open(f1.get_name(), "wb") as f:
+                f.write(b"exists\n")
+            failed = []
+
+            def check_failed(*args):
+                failed.append(args)
+
+            push.check_failed.connect(check_failed)
+            try:
+                self.assertEqual([patch1], push.check_all(jobs=1))
+            finally:
+                push.check_failed.disconnect(check_failed)
+            [(patch, [(filename, result)], error)] = failed
+            self.assertEqual(patch1, patch)
+            self.assertEqual("f1", filename)
+            self.assertTrue(result.failed())
+            self.assertFalse(f2.exists())
+
+    def test_apply_patch(self):
+        patch1 = Patch("p1.patch")
+        patch2 = Patch("p2.patch")
+
+        test_dir = self.data_dir + "test1"
+
+        with TmpDirectory(dir=self.data_dir.get_name()) as tmp_dir:
+            tmp_test_dir = tmp_dir + "test1"
+            test_dir.copy(tmp_test_dir)
+
+            pc_dir = tmp_test_dir + "pc"
+            patches_dir = tmp_test_dir + "patches"
+
+            push = Push(tmp_test_dir.get_name(), pc_dir.get_name(),
+                        patches_dir.get_name())
+            push.apply_patch("p1.patch", quiet=True)
+            self.assertEqual(patch1, push.db.top_patch())
+
+            # the applied patches are skipped
+            push.apply_patch("p2.patch", quiet=True)
+            self.assertEqual([patch1, patch2], push.db.applied_patches())
+
     def test_apply_next(self):
         patch1 = Patch("p1.patch")
         patch2 = Patch("p2.patch")
@@ -39,3 +39,79 @@ class Test(TestCase):
                     self.assertTrue(patch.read(30))
             finally:
                 os.chdir(old_dir)
+
+    def test_refresh_jobs(self):
+        with TmpDirectory() as dir:
+            old_dir = os.getcwd()
+            try:
+                os.chdir(dir.get_name())
+                db = Db(".pc")
+                db.create()
+                backup = os.path.join(".pc", "patch")
+                os.mkdir(backup)
+                for name in ("a", "b", "c"):
+                    with open(os.path.join(backup, name), "wb") as file:
+                        file.write(b"old\n")
+                    with open(name, "wb") as file:
+                        file.write(b"new " + name.encode("ascii") + b"\n")
+                db.add_patch(Patch("patch"))
+                db.save()
+                with open("patch", "wb") as file:
+                    pass
+
+                cmd = quilt.refresh.Refresh(".", ".pc", ".")
+                cmd.refresh(jobs=2)
+                with open("patch", "rb") as patch:
+                    content = patch.read()
+                for name in ("a", "b", "c"):
+                    self.assertTrue(b"+new " + name.encode("ascii") in content)
+
+                # the output is the same as the one of a single process
+                with open("patch", "wb") as file:
+                    pass
+                cmd.refresh(jobs=1)
+                with open("patch", "rb") as patch:
+                    self.assertEqual(content, patch.read())
+            finally:
+                os.chdir(old_dir)
+
+    def test_refresh_cached(self):
+        with TmpDirectory() as dir:
+            old_dir = os.getcwd()
+            try:
+                os.chdir(dir.get_name())
+                db = Db(".pc")
+                db.create()
+                backup = os.path.join(".pc", "patch")
+                os.mkdir(backup)
+                with open(os.path.join(backup, "file"), "wb") as file:
+                    file.write(b"old\n")
+                with open("file", "wb") as file:
+                    file.write(b"new\n")
+                # pretend the files are old enough to trust their mtime
+                for name in ("file", os.path.join(backup, "file")):
+                    os.utime(name, (1000000000, 1000000000))
+                db.add_patch(Patch("patch"))
+                db.save()
+                with open("patch", "wb") as file:
+                    pass
+
+                cmd = quilt.refresh.Refresh(".", ".pc", ".")
+                cmd.refresh()
+
+                # the size and mtime are unchanged, the cached diff is used
+                with open("file", "wb") as file:
+                    file.write(b"NEW\n")
+                os.utime("file", (1000000000, 1000000000))
+                with open("patch", "wb") as file:
+                    pass
+                cmd.refresh()
+                with open("patch", "rb") as patch:
+                    self.assertTrue(b"+new\n" in patch.read())
+
+                os.utime("file", (1000000001, 1000000001))
+                cmd.refresh()
+                with open("patch", "rb") as patch:
+                    self.assertTrue(b"+NEW\n" in patch.read())
+            finally:
+                os.chdir(old_dir)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf-8 et sw=4 ts=4 tw=80:
+
+# python-quilt - A Python implementation of the quilt patch system
+#
+# See LICENSE comming with the source of python-quilt for details.
+
+from unittest import TestCase
+
+from quilt.unidiff import split_lines, unified_diff
+
+
+def data(string):
+    return b"".join([line + b"\n" for line in string.split()])
+
+
+class UnifiedDiffTest(TestCase):
+
+    def test_equal(self):
+        self.assertEqual(b"", unified_diff(b"a\n", b"a\n", b"a", b"b"))
+
+    def test_split_lines(self):
+        self.assertEqual([b"a\r\n", b"b"], split_lines(b"a\r\nb"))
+        self.assertEqual([], split_lines(b""))
+
+    def test_hunks(self):
+        left = data(b"1 2 3 4 5 6 7 8 9 10 11 12 13 14 15 16 17")
+        right = data(b"1 2 3 4 X 6 7 8 9 10 11 12 13 14 15 Y 17")
+        self.assertEqual(b"""\
+--- a
++++ b
+@@ -2,7 +2,7 @@
+ 2
+ 3
+ 4
+-5
++X
+ 6
+ 7
+ 8
+@@ -13,5 +13,5 @@
+ 13
+ 14
+ 15
+-16
++Y
+ 17
+""", unified_diff(left, right, b"a", b"b"))
+
+    def test_new_file(self):
+        self.assertEqual(b"""\
+--- a
++++ b
+@@ -0,0 +1,2 @@
++1
++2
+\\ No newline at end of file
+""", unified_diff(b"", b"1\n2", b"a", b"b"))
+
+    def test_shift(self):
+        # like GNU diff the inserted lines are moved to the end
+        self.assertEqual(b"""\
+--- a
++++ b
+@@ -1,3 +1,5 @@
+ a
+ b
+ a
++b
++a
+""", unified_diff(data(b"a b a"), data(b"a b a b a"), b"a", b"b"))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf-8 et sw=4 ts=4 tw=80:
+
+# python-quilt - A Python implementation of the quilt patch system
+#
+# See LICENSE comming with the source of python-quilt for details.
+
+import os
+import os.path
+
+from unittest import TestCase
+
+from quilt.error import QuiltError
+from quilt.utils import COPY_METHODS, Directory, TmpDirectory, copy_file, \
+                        set_copy_method
+
+
+class CopyFileTest(TestCase):
+
+    def test_methods(self):
+        with TmpDirectory() as dir:
+            src = os.path.join(dir.get_name(), "src")
+            with open(src, "wb") as f:
+                f.write(b"data\n" * 1000)
+            os.chmod(src, 0o640)
+            for method in COPY_METHODS:
+                dst = os.path.join(dir.get_name(), method)
+                copy_file(src, dst, method)
+                with open(dst, "rb") as f:
+                    self.assertEqual(b"data\n" * 1000, f.read())
+                self.assertEqual(0o640, os.stat(dst).st_mode & 0o777)
+
+    def test_directory(self):
+        with TmpDirectory() as dir:
+            src = os.path.join(dir.get_name(), "src")
+            with open(src, "wb") as f:
+                f.write(b"data\n")
+            dest_dir = os.path.join(dir.get_name(), "dir")
+            os.mkdir(dest_dir)
+            copy_file(src, dest_dir)
+            self.assertTrue(os.path.exists(os.path.join(dest_dir, "src")))
+
+    def test_set_copy_method(self):
+        self.assertRaises(QuiltError, set_copy_method, "unknown")
+
+
+class DirectoryTest(TestCase):
+
+    def test_walk(self):
+        with TmpDirectory() as dir:
+            os.makedirs(os.path.join(dir.get_name(), "a", "b"))
+            os.mkdir(os.path.join(dir.get_name(), "c"))
+            for name in ("f", os.path.join("a", "g"),
+                         os.path.join("a", "b", "h")):
+                open(os.path.join(dir.get_name(), name), "w").close()
+
+            entries = list(dir.walk())
+            self.assertEqual(sorted([("a", True), ("c", True), ("f", False),
+                                     (os.path.join("a", "b"), True),
+                                     (os.path.join("a", "g"), False),
+                                     (os.path.join("a", "b", "h"), False)]),
+                             sorted(entries))
+            # directories are returned before their content
+            names = [name for name, is_dir in entries]
+            self.assertTrue(names.index("a") <
+                            names.index(os.path.join("a", "b")) <
+                            names.index(os.path.join("a", "b", "h")))
+
+            dirs, files = dir.content()
+            self.assertEqual(sorted(["f", os.path.join("a", "g"),
+                                     os.path.join("a", "b", "h")]),
+                             sorted(files))
+            self.assertEqual(sorted(files), sorted(dir.files()))
+
+            self.assertFalse(dir.is_empty())
+            self.assertTrue(Directory(os.path.join(dir.get_name(),
+                                                   "c")).is_empty())